@@ -24,13 +24,88 @@ __author__ = "Anthony Liu"
 
 __version__ = "0.0.1"
 
+import time
+
+# for --startup-timing
+START_TIME = time.time()
+
 import os
 import sys
 import subprocess
+import select
 import math
 import colorsys
-import time
 import re
+import bisect
+import threading
+import atexit
+import hashlib
+import getpass
+
+# multiprocessing and ctypes, which take several milliseconds to import,
+# and QtNetwork are only needed by some options and are imported where
+# they are used
+
+
+def get_instance_name():
+    """Return the local socket of the viewer that opens the files of later
+    invocations."""
+    return 'qdot-' + getpass.getuser()
+
+
+def forward_to_instance(filename, name=None, timeout=1000):
+    """Hand filename over to a running viewer, and return whether there was
+    one to take it.
+
+    Where QLocalServer listens on a Unix socket, this needs no Qt module.
+    """
+    import socket
+    if name is None:
+        name = get_instance_name()
+    path = os.path.abspath(filename) + '\n'
+    if not hasattr(socket, 'AF_UNIX'):
+        # a named pipe on Windows
+        from PyQt4 import QtNetwork
+        client = QtNetwork.QLocalSocket()
+        client.connectToServer(name)
+        if not client.waitForConnected(timeout):
+            return False
+        client.write(path)
+        written = client.waitForBytesWritten(timeout)
+        client.disconnectFromServer()
+        return written
+    if not os.path.isabs(name):
+        # where QLocalServer puts the socket, after QDir::tempPath()
+        name = os.path.join(os.environ.get('TMPDIR') or '/tmp', name)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout / 1000.0)
+    try:
+        try:
+            client.connect(name)
+        except socket.error:
+            return False
+        try:
+            client.sendall(path)
+        except socket.error:
+            return False
+        return True
+    finally:
+        client.close()
+
+
+def forward_early(argv):
+    """Hand the file of `qdot -1 FILE` over to a running viewer, and return
+    whether one took it.  Other arguments are left to main()."""
+    args = [arg for arg in argv if arg not in ('-1', '--single-instance')]
+    if (len(args) != 1 or len(argv) != 2 or args[0].startswith('-') or
+            not os.path.isfile(args[0])):
+        return False
+    return forward_to_instance(args[0])
+
+
+# the Qt modules take most of the start-up time
+if __name__ == '__main__' and forward_early(sys.argv[1:]):
+    sys.exit(0)
 
 from PyQt4 import QtCore
 from PyQt4 import QtGui
@@ -98,6 +173,9 @@ class Pen(object):
 class Shape(object):
     """Abstract base class for all the drawing shapes."""
 
+    # detail shapes are left out of draft paints
+    detail = False
+
     def __init__(self):
         pass
 
@@ -117,6 +195,8 @@ class Shape(object):
 class TextShape(Shape):
     LEFT, CENTER, RIGHT = -1, 0, 1
 
+    detail = True
+
     def __init__(self, pen, x, y, j, w, t):
         Shape.__init__(self)
         if 0:
@@ -127,9 +207,40 @@ class TextShape(Shape):
         self.j = j
         self.w = w
         self.t = t
+        self.path = None
+
+    MIN_SIZE = 3.0  # pixels; smaller text is not legible, so skip it
 
     def draw(self, scene, painter, rect, highlight=False):
         pen = self.select_pen(highlight)
+        lod = QtGui.QStyleOptionGraphicsItem.levelOfDetailFromTransform(
+            painter.worldTransform())
+        if pen.fontsize * lod < self.MIN_SIZE:
+            return
+
+        if self.path is None:
+            self.path = self.get_path(pen)
+
+        p = QtGui.QPen(pen.color)
+        p.setWidth(pen.linewidth)
+        p.setCosmetic(True)
+        painter.setPen(p)
+        painter.fillPath(self.path, QtGui.QBrush(pen.fillcolor))
+
+        if 0:  # DEBUG
+            # show where dot thinks the text should appear
+            painter.set_source_rgba(1, 0, 0, .9)
+            if self.j == self.LEFT:
+                x = self.x
+            elif self.j == self.CENTER:
+                x = self.x - 0.5 * self.w
+            elif self.j == self.RIGHT:
+                x = self.x - self.w
+            painter.moveTo(x, self.y)
+            painter.line_to(x + self.w, self.y)
+            painter.stroke()
+
+    def get_path(self, pen):
         font = QtGui.QFont(pen.fontname)
 
         if 0:
@@ -155,53 +266,35 @@ class TextShape(Shape):
         pp = QtGui.QPainterPath()
         pp.moveTo(x, y)
         pp.addText(x, y, font, self.t)
-
-        p = QtGui.QPen(pen.color)
-        p.setWidth(pen.linewidth)
-        p.setCosmetic(True)
-        painter.setPen(p)
-        painter.fillPath(pp, QtGui.QBrush(pen.fillcolor))
-
-        if 0:  # DEBUG
-            # show where dot thinks the text should appear
-            painter.set_source_rgba(1, 0, 0, .9)
-            if self.j == self.LEFT:
-                x = self.x
-            elif self.j == self.CENTER:
-                x = self.x - 0.5 * self.w
-            elif self.j == self.RIGHT:
-                x = self.x - self.w
-            painter.moveTo(x, self.y)
-            painter.line_to(x + self.w, self.y)
-            painter.stroke()
+        return pp
 
 
 class EllipseShape(Shape):
     def __init__(self, pen, x0, y0, w, h, filled=False):
         Shape.__init__(self)
 
-        self.drawn = False
         self.pen = pen.copy()
+        self.x0 = x0
+        self.y0 = y0
+        self.w = w
+        self.h = h
         self.filled = filled
-
-        self.item = QtGui.QGraphicsEllipseItem()
-        self.item.setRect(QtCore.QRectF(x0 - w, y0 - h, w * 2, h * 2))
-        self.item.setStartAngle(180)
-        self.item.setSpanAngle(360 * 16)
+        self.path = None
 
     def draw(self, scene, painter, rect, highlight=False):
-        if self.drawn == False:
-            scene.addItem(self.item)
-            self.drawn = True
-
-        p = self.select_pen(highlight)
-
-        if (self.filled):
-            self.item.setBrush(QtGui.QBrush(p.fillcolor))
+        if self.path is None:
+            self.path = QtGui.QPainterPath()
+            self.path.addEllipse(QtCore.QRectF(
+                self.x0 - self.w, self.y0 - self.h, self.w * 2, self.h * 2))
+        pen = self.select_pen(highlight)
+        if self.filled:
+            painter.fillPath(self.path, QtGui.QBrush(pen.fillcolor))
         else:
-            pen = QtGui.QPen(p.fillcolor)
-            pen.setWidthF(p.linewidth)
-            self.item.setPen(pen)
+            p = QtGui.QPen(pen.color)
+            p.setWidth(pen.linewidth)
+            p.setCosmetic(True)
+            painter.setPen(p)
+            painter.drawPath(self.path)
 
 
 class PolygonShape(Shape):
@@ -210,14 +303,17 @@ class PolygonShape(Shape):
         self.pen = pen.copy()
         self.points = points
         self.filled = filled
+        self.path = None
 
     def draw(self, scene, painter, rect, highlight=False):
-        path = QtGui.QPainterPath()
-        x0, y0 = self.points[-1]
-        path.moveTo(x0, y0)
-        for x, y in self.points:
-            path.lineTo(x, y)
-        path.closeSubpath()
+        if self.path is None:
+            self.path = QtGui.QPainterPath()
+            x0, y0 = self.points[-1]
+            self.path.moveTo(x0, y0)
+            for x, y in self.points:
+                self.path.lineTo(x, y)
+            self.path.closeSubpath()
+        path = self.path
         pen = self.select_pen(highlight)
         if self.filled:
             painter.fillPath(path, QtGui.QBrush(pen.fillcolor))
@@ -253,16 +349,19 @@ class BezierShape(Shape):
         self.pen = pen.copy()
         self.points = points
         self.filled = filled
+        self.path = None
 
     def draw(self, scene, painter, rect, highlight=False):
-        path = QtGui.QPainterPath()
-        x0, y0 = self.points[0]
-        path.moveTo(x0, y0)
-        for i in xrange(1, len(self.points), 3):
-            x1, y1 = self.points[i]
-            x2, y2 = self.points[i + 1]
-            x3, y3 = self.points[i + 2]
-            path.cubicTo(x1, y1, x2, y2, x3, y3)
+        if self.path is None:
+            self.path = QtGui.QPainterPath()
+            x0, y0 = self.points[0]
+            self.path.moveTo(x0, y0)
+            for i in xrange(1, len(self.points), 3):
+                x1, y1 = self.points[i]
+                x2, y2 = self.points[i + 1]
+                x3, y3 = self.points[i + 2]
+                self.path.cubicTo(x1, y1, x2, y2, x3, y3)
+        path = self.path
         pen = self.select_pen(highlight)
         if self.filled:
             painter.fillPath(path, QtGui.QBrush(pen.fillcolor))
@@ -280,8 +379,10 @@ class CompoundShape(Shape):
         Shape.__init__(self)
         self.shapes = shapes
 
-    def draw(self, scene, painter, rect, highlight=False):
+    def draw(self, scene, painter, rect, highlight=False, draft=False):
         for shape in self.shapes:
+            if draft and shape.detail:
+                continue
             shape.draw(scene, painter, rect, highlight=highlight)
 
 
@@ -318,9 +419,10 @@ class Element(CompoundShape):
 
 
 class Node(Element):
-    def __init__(self, x, y, w, h, shapes, url):
+    def __init__(self, x, y, w, h, shapes, url, id=None):
         Element.__init__(self, shapes)
 
+        self.id = id
         self.x = x
         self.y = y
 
@@ -330,6 +432,12 @@ class Node(Element):
         self.y2 = y + 0.5 * h
 
         self.url = url
+        # the xdot attributes the shapes were made from, see XDotParser
+        self.signature = None
+
+        # adjacency, filled in by XDotParser.handle_edge
+        self.out_edges = []
+        self.in_edges = []
 
     def is_inside(self, x, y):
         return self.x1 <= x and x <= self.x2 and self.y1 <= y and y <= self.y2
@@ -354,48 +462,235 @@ def square_distance(x1, y1, x2, y2):
     return deltax * deltax + deltay * deltay
 
 
+def flatten_bezier(points, steps=8):
+    """Approximate a piecewise cubic bezier with a polyline."""
+    if len(points) < 4 or (len(points) - 1) % 3:
+        return list(points)
+    polyline = [points[0]]
+    for i in xrange(1, len(points), 3):
+        x0, y0 = points[i - 1]
+        x1, y1 = points[i]
+        x2, y2 = points[i + 1]
+        x3, y3 = points[i + 2]
+        for j in xrange(1, steps + 1):
+            t = float(j) / steps
+            s = 1.0 - t
+            a, b, c, d = s * s * s, 3 * s * s * t, 3 * s * t * t, t * t * t
+            polyline.append((a * x0 + b * x1 + c * x2 + d * x3,
+                             a * y0 + b * y1 + c * y2 + d * y3))
+    return polyline
+
+
+def segment_square_distance(x, y, x1, y1, x2, y2):
+    """Return the square distance from a point to a segment, and where along
+    the segment (0 to 1) the closest point is."""
+    deltax = x2 - x1
+    deltay = y2 - y1
+    length = deltax * deltax + deltay * deltay
+    if length:
+        t = ((x - x1) * deltax + (y - y1) * deltay) / length
+        t = max(0.0, min(t, 1.0))
+    else:
+        t = 0.0
+    return square_distance(x, y, x1 + t * deltax, y1 + t * deltay), t
+
+
 class Edge(Element):
     def __init__(self, src, dst, points, shapes):
         Element.__init__(self, shapes)
         self.src = src
         self.dst = dst
         self.points = points
+        self.segments = None
+        self.signature = None
 
     RADIUS = 10
 
+    def get_segments(self):
+        """Return the flattened edge as (x1, y1, x2, y2, p1, p2) segments,
+        where p1 and p2 say how far along the edge (0 to 1) they are."""
+        if self.segments is None:
+            polyline = flatten_bezier(self.points)
+            if len(polyline) == 1:
+                polyline = polyline * 2
+            n = float(len(polyline) - 1)
+            self.segments = [
+                polyline[i] + polyline[i + 1] + (i / n, (i + 1) / n)
+                for i in xrange(len(polyline) - 1)
+            ]
+        return self.segments
+
     def get_jump(self, x, y):
-        if square_distance(x, y, *self.points[0]) <= self.RADIUS * self.RADIUS:
+        best_distance = self.RADIUS * self.RADIUS
+        position = None
+        for x1, y1, x2, y2, p1, p2 in self.get_segments():
+            distance, t = segment_square_distance(x, y, x1, y1, x2, y2)
+            if distance <= best_distance:
+                best_distance = distance
+                position = p1 + t * (p2 - p1)
+        if position is None:
+            return None
+        return self.jump_from(position)
+
+    def jump_from(self, position):
+        """Jump to the far end of the edge, seen from a point that is
+        position (0 to 1) along it."""
+        if position < 0.5:
             return Jump(self, self.dst.x, self.dst.y, highlight=set([self, self.dst]))
-        if square_distance(x, y, *self.points[-1]) <= self.RADIUS * self.RADIUS:
-            return Jump(self, self.src.x, self.src.y, highlight=set([self, self.src]))
-        return None
+        return Jump(self, self.src.x, self.src.y, highlight=set([self, self.src]))
+
+
+class EdgeIndex(object):
+    """Uniform grid over the flattened edge segments, so that the edge
+    nearest to a point is found by looking at a few cells only."""
+
+    CELL = 32.0
+
+    def __init__(self, edges):
+        self.cells = {}
+        for edge in edges:
+            for segment in edge.get_segments():
+                x1, y1, x2, y2 = segment[:4]
+                entry = (edge, segment)
+                for cell in self.get_cells(min(x1, x2), min(y1, y2),
+                                           max(x1, x2), max(y1, y2)):
+                    self.cells.setdefault(cell, []).append(entry)
+
+    def get_cells(self, x1, y1, x2, y2):
+        i1 = int(math.floor(x1 / self.CELL))
+        j1 = int(math.floor(y1 / self.CELL))
+        i2 = int(math.floor(x2 / self.CELL))
+        j2 = int(math.floor(y2 / self.CELL))
+        for i in xrange(i1, i2 + 1):
+            for j in xrange(j1, j2 + 1):
+                yield i, j
+
+    def get_jump(self, x, y, radius):
+        best_distance = radius * radius
+        best = None
+        for cell in self.get_cells(x - radius, y - radius, x + radius, y + radius):
+            for edge, segment in self.cells.get(cell, ()):
+                x1, y1, x2, y2, p1, p2 = segment
+                distance, t = segment_square_distance(x, y, x1, y1, x2, y2)
+                if distance <= best_distance:
+                    best_distance = distance
+                    best = edge, p1 + t * (p2 - p1)
+        if best is None:
+            return None
+        edge, position = best
+        return edge.jump_from(position)
+
+
+class SearchIndex(object):
+    """Node lookup by id or label text.
+
+    Texts are collected while parsing and indexed on the first search: they
+    are sorted for prefix lookups and joined into one string that str.find
+    scans for substrings, so queries run at C speed whatever the graph size.
+    """
+
+    SEPARATOR = '\0'
+
+    def __init__(self):
+        self.entries = []
+        self.keys = None
+
+    def add(self, text, node):
+        key = text.lower().replace(self.SEPARATOR, '')
+        if key:
+            self.entries.append((key, node))
+
+    def extend(self, other):
+        self.entries.extend(other.entries)
+        self.keys = None
+
+    def build(self):
+        self.entries.sort(key=lambda entry: entry[0])
+        self.keys = [key for key, node in self.entries]
+        self.offsets = []
+        offset = 0
+        for key in self.keys:
+            self.offsets.append(offset)
+            offset += len(key) + len(self.SEPARATOR)
+        self.text = self.SEPARATOR.join(self.keys)
+
+    def search(self, text, limit=100):
+        """Return up to limit nodes whose id or label contains text,
+        prefix matches first."""
+        if self.keys is None:
+            self.build()
+        query = text.lower()
+        if not query:
+            return []
+
+        results = []
+        seen = set()
+
+        def add(i):
+            node = self.entries[i][1]
+            if node not in seen:
+                seen.add(node)
+                results.append(node)
+
+        i = bisect.bisect_left(self.keys, query)
+        while (i < len(self.keys) and self.keys[i].startswith(query)
+                and len(results) < limit):
+            add(i)
+            i += 1
+
+        pos = self.text.find(query)
+        while pos != -1 and len(results) < limit:
+            i = bisect.bisect_right(self.offsets, pos) - 1
+            add(i)
+            # look for the next match in the following key
+            pos = self.text.find(query, self.offsets[i] + len(self.keys[i]))
+        return results
 
 
 class Graph(Shape):
-    def __init__(self, width=1, height=1, shapes=(), nodes=(), edges=()):
+    def __init__(self, width=1, height=1, shapes=(), nodes=(), edges=(),
+                 node_by_name=None, search_index=None, origin=(0, 0)):
         Shape.__init__(self)
 
         self.width = width
         self.height = height
+        # top left corner
+        self.x, self.y = origin
         self.shapes = shapes
         self.nodes = nodes
         self.edges = edges
+        if node_by_name is None:
+            node_by_name = {}
+        self.node_by_name = node_by_name
+        if search_index is None:
+            search_index = SearchIndex()
+        self.search_index = search_index
+        self.edge_index = None
 
     def get_size(self):
         return self.width, self.height
 
-    def draw(self, scene, painter, rect, highlight_items=None):
+    def get_rect(self):
+        return self.x, self.y, self.width, self.height
+
+    def draw(self, scene, painter, rect, highlight_items=None, draft=False):
         if highlight_items is None:
             highlight_items = ()
 
         # for shape in self.shapes:
         #	shape.draw(scene, painter, rect)
         for edge in self.edges:
-            edge.draw(
-                scene, painter, rect, highlight=(edge in highlight_items))
+            edge.draw(scene, painter, rect,
+                      highlight=(edge in highlight_items), draft=draft)
         for node in self.nodes:
-            node.draw(
-                scene, painter, rect, highlight=(node in highlight_items))
+            node.draw(scene, painter, rect,
+                      highlight=(node in highlight_items), draft=draft)
+
+    def get_neighbors(self, node):
+        """Return (edge, neighbor) pairs for the edges of node, outgoing
+        edges first."""
+        return ([(edge, edge.dst) for edge in node.out_edges] +
+                [(edge, edge.src) for edge in node.in_edges])
 
     def get_url(self, x, y):
         for node in self.nodes:
@@ -405,10 +700,11 @@ class Graph(Shape):
         return None
 
     def get_jump(self, x, y):
-        for edge in self.edges:
-            jump = edge.get_jump(x, y)
-            if jump is not None:
-                return jump
+        if self.edge_index is None:
+            self.edge_index = EdgeIndex(self.edges)
+        jump = self.edge_index.get_jump(x, y, Edge.RADIUS)
+        if jump is not None:
+            return jump
         for node in self.nodes:
             jump = node.get_jump(x, y)
             if jump is not None:
@@ -417,24 +713,45 @@ class Graph(Shape):
 
 
 class Animation(QtCore.QObject):
-    step = 0.03  # seconds
+    step = 0.015  # seconds
+    duration = 0.6  # seconds
 
     def __init__(self, dot_widget):
+        QtCore.QObject.__init__(self)
         self.dot_widget = dot_widget
-        self.timeout_id = None
+        self.timeline = None
 
     def start(self):
-        self.timeout_id = self.StartTimer(int(self.step * 1000), self.tick)
+        # QTimeLine derives each frame from the elapsed time, so when
+        # painting is slow frames get dropped instead of the animation
+        # slowing down
+        self.timeline = QtCore.QTimeLine(
+            int(self.duration * 1000), self.dot_widget)
+        self.timeline.setUpdateInterval(int(self.step * 1000))
+        self.timeline.setCurveShape(QtCore.QTimeLine.EaseInOutCurve)
+        self.timeline.valueChanged.connect(self.tick)
+        self.timeline.finished.connect(self.finish)
+        self.dot_widget.begin_draft()
+        self.timeline.start()
 
     def stop(self):
         self.dot_widget.animation = NoAnimation(self.dot_widget)
-        if self.timeout_id is not None:
-            self.killTimer(self.timeout_id)
-            self.timeout_id = None
-
-    def tick(self):
+        if self.timeline is not None:
+            self.timeline.stop()
+            self.timeline.deleteLater()
+            self.timeline = None
+            self.dot_widget.end_draft()
+
+    def finish(self):
+        self.animate(1.0)
         self.stop()
 
+    def tick(self, t):
+        self.animate(t)
+
+    def animate(self, t):
+        pass
+
 
 class NoAnimation(Animation):
     def start(self):
@@ -444,6 +761,73 @@ class NoAnimation(Animation):
         pass
 
 
+class MoveToAnimation(Animation):
+    def __init__(self, dot_widget, target_x, target_y):
+        Animation.__init__(self, dot_widget)
+        self.source_x, self.source_y = dot_widget.get_current_pos()
+        self.target_x = target_x
+        self.target_y = target_y
+        self.source_zoom = dot_widget.get_zoom_ratio()
+        self.target_zoom = self.source_zoom
+
+    def animate(self, t):
+        sx, sy = self.source_x, self.source_y
+        tx, ty = self.target_x, self.target_y
+        self.dot_widget.set_view(
+            tx * t + sx * (1 - t),
+            ty * t + sy * (1 - t),
+            self.get_zoom(t))
+
+    def get_zoom(self, t):
+        return self.target_zoom
+
+
+class ZoomToAnimation(MoveToAnimation):
+    """Move to a point, zooming out on the way if it is far away."""
+
+    def __init__(self, dot_widget, target_x, target_y):
+        MoveToAnimation.__init__(self, dot_widget, target_x, target_y)
+        self.extra_zoom = 0
+
+        middle_zoom = 0.5 * (self.source_zoom + self.target_zoom)
+
+        distance = math.hypot(self.source_x - self.target_x,
+                              self.source_y - self.target_y)
+        rect = dot_widget.viewport().rect()
+        visible = min(rect.width(), rect.height()) / self.source_zoom
+        visible *= 0.9
+        if distance > 0:
+            desired_middle_zoom = visible / distance
+            self.extra_zoom = min(0, 4 * (desired_middle_zoom - middle_zoom))
+
+    def get_zoom(self, t):
+        a, b, c = self.source_zoom, self.extra_zoom, self.target_zoom
+        return c * t + b * t * (1 - t) + a * (1 - t)
+
+
+class ZoomAnimation(Animation):
+    """Zoom to a ratio, keeping the graph point under pos in place."""
+
+    duration = 0.2  # seconds
+
+    def __init__(self, dot_widget, target_zoom, pos=None):
+        Animation.__init__(self, dot_widget)
+        if pos is None:
+            pos = dot_widget.viewport().rect().center()
+        self.pos = pos
+        self.anchor = dot_widget.mapToScene(pos)
+        self.source_zoom = dot_widget.get_zoom_ratio()
+        self.target_zoom = target_zoom
+
+    def animate(self, t):
+        # interpolate geometrically so every frame zooms by the same factor
+        zoom = self.source_zoom * (self.target_zoom / self.source_zoom) ** t
+        rect = self.dot_widget.viewport().rect()
+        x = self.anchor.x() - (self.pos.x() - 0.5 * rect.width()) / zoom
+        y = self.anchor.y() - (self.pos.y() - 0.5 * rect.height()) / zoom
+        self.dot_widget.set_view(x, y, zoom)
+
+
 class Token(object):
     def __init__(self, type, text, line, col):
         self.type = type
@@ -477,8 +861,9 @@ class Parser(object):
                 col=self.lookahead.col)
 
     def skip(self, type):
-        while self.lookahead.type != type:
+        while self.lookahead.type not in (type, EOF):
             self.consume()
+        self.match(type)
 
     def consume(self):
         token = self.lookahead
@@ -486,6 +871,40 @@ class Parser(object):
         return token
 
 
+def parse_color(c):
+    """Return the (r, g, b, a) floats of a graphviz color, or None."""
+    # See http://www.graphviz.org/doc/info/attrs.html#k:color
+    c1 = c[:1]
+    if c1 == '#':
+        hex2float = lambda h: float(int(h, 16) / 255.0)
+        try:
+            r = hex2float(c[1:3])
+            g = hex2float(c[3:5])
+            b = hex2float(c[5:7])
+        except ValueError:
+            return None
+        try:
+            a = hex2float(c[7:9])
+        except (IndexError, ValueError):
+            a = 1.0
+        return r, g, b, a
+    elif c1.isdigit() or c1 == ".":
+        # "H,S,V" or "H S V" or "H, S, V" or any other variation
+        try:
+            h, s, v = map(float, c.replace(",", " ").split())
+        except ValueError:
+            return None
+        r, g, b = colorsys.hsv_to_rgb(h, s, v)
+        a = 1.0
+        return r, g, b, a
+    else:
+        # most X11 color names are SVG color names too
+        color = QtGui.QColor(c)
+        if not color.isValid():
+            return None
+        return color.getRgbF()
+
+
 class XDotAttrParser(object):
     """Parser for xdot drawing attributes.
     See also:
@@ -545,28 +964,12 @@ class XDotAttrParser(object):
         return p
 
     def read_color(self):
-        # See http://www.graphviz.org/doc/info/attrs.html#k:color
         c = self.read_text()
-        c1 = c[:1]
-        if c1 == '#':
-            hex2float = lambda h: float(int(h, 16) / 255.0)
-            r = hex2float(c[1:3])
-            g = hex2float(c[3:5])
-            b = hex2float(c[5:7])
-            try:
-                a = hex2float(c[7:9])
-            except (IndexError, ValueError):
-                a = 1.0
-            return r, g, b, a
-        elif c1.isdigit() or c1 == ".":
-            # "H,S,V" or "H S V" or "H, S, V" or any other variation
-            h, s, v = map(float, c.replace(",", " ").split())
-            r, g, b = colorsys.hsv_to_rgb(h, s, v)
-            a = 1.0
-            return r, g, b, a
-        else:
+        color = parse_color(c)
+        if color is None:
             print 'TODO: implement text-based color parsing'
             return 0, 0, 0, 1.0
+        return color
 
     def parse(self):
         s = self
@@ -880,12 +1283,55 @@ class DotLexer(Lexer):
         return type, text
 
 
+class DotId(str):
+    """An id read from DOT source, which also remembers how it was written,
+    escapes and HTML delimiters included."""
+
+    def __new__(cls, text, source):
+        self = str.__new__(cls, text)
+        self.source = source
+        return self
+
+
+class DotEndpoint(str):
+    """A node id at one end of an edge, with the port and compass point it
+    was written with."""
+
+    def __new__(cls, id, port, compass_pt):
+        self = str.__new__(cls, id)
+        self.id = id
+        self.port = (port, compass_pt)
+        return self
+
+
+def get_port(id):
+    """Return the port and compass point of an edge end."""
+    return getattr(id, 'port', (None, None))
+
+
+class DotSourceLexer(DotLexer):
+    """A DotLexer whose quoted and HTML ids can be written back as they
+    were read."""
+
+    def filter(self, type, text):
+        if type in (STR_ID, HTML_ID):
+            source = text
+            type, text = DotLexer.filter(self, type, text)
+            text = DotId(text, source)
+        return type, text
+
+
 class DotParser(Parser):
     def __init__(self, lexer):
         Parser.__init__(self, lexer)
         self.graph_attrs = {}
         self.node_attrs = {}
         self.edge_attrs = {}
+        # ids of the subgraphs being parsed, innermost last, None for
+        # anonymous ones
+        self.subgraph_ids = []
+        # node ids seen inside subgraphs used as edge operands
+        self.operand_node_ids = []
 
     def parse(self):
         self.parse_graph()
@@ -909,9 +1355,19 @@ class DotParser(Parser):
                 self.consume()
         if self.lookahead.type == LCURLY:
             self.consume()
+            # default attributes set inside a subgraph stay inside it
+            node_attrs = self.node_attrs
+            edge_attrs = self.edge_attrs
+            self.node_attrs = dict(node_attrs)
+            self.edge_attrs = dict(edge_attrs)
+            self.subgraph_ids.append(id)
+            self.handle_subgraph(id)
             while self.lookahead.type != RCURLY:
                 self.parse_stmt()
             self.consume()
+            self.subgraph_ids.pop()
+            self.node_attrs = node_attrs
+            self.edge_attrs = edge_attrs
         return id
 
     def parse_stmt(self):
@@ -927,26 +1383,51 @@ class DotParser(Parser):
             self.consume()
             self.edge_attrs.update(self.parse_attrs())
         elif self.lookahead.type in (SUBGRAPH, LCURLY):
-            self.parse_subgraph()
+            node_ids = self.parse_edge_operand()
+            if self.lookahead.type == EDGE_OP:
+                self.parse_edge_stmt(node_ids)
         else:
             id = self.parse_node_id()
             if self.lookahead.type == EDGE_OP:
-                self.consume()
-                node_ids = [id, self.parse_node_id()]
-                while self.lookahead.type == EDGE_OP:
-                    node_ids.append(self.parse_node_id())
-                attrs = self.parse_attrs()
-                for i in range(0, len(node_ids) - 1):
-                    self.handle_edge(node_ids[i], node_ids[i + 1], attrs)
+                self.parse_edge_stmt([id])
             elif self.lookahead.type == EQUAL:
                 self.consume()
-                self.parse_id()
+                attrs = {id: self.parse_id()}
+                self.graph_attrs.update(attrs)
+                self.handle_graph(attrs)
             else:
                 attrs = self.parse_attrs()
                 self.handle_node(id, attrs)
         if self.lookahead.type == SEMI:
             self.consume()
 
+    def parse_edge_stmt(self, node_ids):
+        operands = [node_ids]
+        while self.lookahead.type == EDGE_OP:
+            self.consume()
+            operands.append(self.parse_edge_operand())
+        attrs = self.parse_attrs()
+        for i in range(0, len(operands) - 1):
+            for src_id in operands[i]:
+                for dst_id in operands[i + 1]:
+                    self.handle_edge(src_id, dst_id, attrs)
+
+    def parse_edge_operand(self):
+        """Return the node ids on one side of an edge operator."""
+        if self.lookahead.type not in (SUBGRAPH, LCURLY):
+            return [self.parse_node_id()]
+        self.operand_node_ids.append([])
+        self.parse_subgraph()
+        node_ids = []
+        seen = set()
+        for node_id in self.operand_node_ids.pop():
+            if node_id not in seen:
+                seen.add(node_id)
+                node_ids.append(node_id)
+        if self.operand_node_ids:
+            self.operand_node_ids[-1].extend(node_ids)
+        return node_ids
+
     def parse_attrs(self):
         attrs = {}
         while self.lookahead.type == LSQUARE:
@@ -981,8 +1462,9 @@ class DotParser(Parser):
         else:
             port = None
             compass_pt = None
-        # XXX: we don't really care about port and compass point values when
-        # parsing xdot
+        node_id = self.handle_port(node_id, port, compass_pt)
+        if self.operand_node_ids:
+            self.operand_node_ids[-1].append(node_id)
         return node_id
 
     def parse_id(self):
@@ -991,9 +1473,17 @@ class DotParser(Parser):
         self.consume()
         return id
 
+    def handle_port(self, id, port, compass_pt):
+        # we don't really care about port and compass point values when
+        # parsing xdot
+        return id
+
     def handle_graph(self, attrs):
         pass
 
+    def handle_subgraph(self, id):
+        pass
+
     def handle_node(self, id, attrs):
         pass
 
@@ -1001,15 +1491,38 @@ class DotParser(Parser):
         pass
 
 
+def index_edges(graph):
+    """Return the edges of a laid out graph that can be reused, by their
+    ends and signature."""
+    edges = {}
+    for edge in graph.edges:
+        if edge.signature is not None:
+            key = (edge.src.id, edge.dst.id, edge.signature)
+            edges.setdefault(key, []).append(edge)
+    return edges
+
+
 class XDotParser(DotParser):
-    def __init__(self, xdotcode):
+    def __init__(self, xdotcode, origin=None, previous=None,
+                 previous_edges=None):
         lexer = DotLexer(buf=xdotcode)
         DotParser.__init__(self, lexer)
 
+        # where the top left corner of the graph goes; by default graphviz
+        # coordinates are only flipped, so that elements that did not move
+        # keep their coordinates whatever the bounding box
+        self.origin = origin
+        # an earlier layout whose unchanged nodes and edges are reused
+        self.previous = previous
+        # index_edges(previous), which parsers of parts of the same graph
+        # share
+        self.previous_edges = previous_edges
+
         self.nodes = []
         self.edges = []
         self.shapes = []
         self.node_by_name = {}
+        self.search_index = SearchIndex()
         self.top_graph = True
 
     def handle_graph(self, attrs):
@@ -1024,8 +1537,14 @@ class XDotParser(DotParser):
 
             xmin, ymin, xmax, ymax = map(float, bb.split(","))
 
-            self.xoffset = -xmin
-            self.yoffset = -ymax
+            if self.origin is None:
+                self.xoffset = 0.0
+                self.yoffset = 0.0
+                self.x, self.y = xmin, -ymax
+            else:
+                self.xoffset = self.origin[0] - xmin
+                self.yoffset = -self.origin[1] - ymax
+                self.x, self.y = self.origin
             self.xscale = 1.0
             self.yscale = -1.0
             # FIXME: scale from points to pixels
@@ -1049,16 +1568,29 @@ class XDotParser(DotParser):
         x, y = self.parse_node_pos(pos)
         w = float(attrs['width']) * 72
         h = float(attrs['height']) * 72
-        shapes = []
-        for attr in ("_draw_", "_ldraw_"):
-            if attr in attrs:
-                parser = XDotAttrParser(self, attrs[attr])
-                shapes.extend(parser.parse())
+        signature = (self.xoffset, self.yoffset, pos,
+                     attrs.get('_draw_'), attrs.get('_ldraw_'))
+        previous = None
+        if self.previous is not None:
+            previous = self.previous.node_by_name.get(id)
+        if previous is not None and previous.signature == signature:
+            shapes = previous.shapes
+        else:
+            shapes = []
+            for attr in ("_draw_", "_ldraw_"):
+                if attr in attrs:
+                    parser = XDotAttrParser(self, attrs[attr])
+                    shapes.extend(parser.parse())
         url = attrs.get('URL', None)
-        node = Node(x, y, w, h, shapes, url)
+        node = Node(x, y, w, h, shapes, url, id)
+        node.signature = signature
         self.node_by_name[id] = node
         if shapes:
             self.nodes.append(node)
+            self.search_index.add(id, node)
+            for shape in shapes:
+                if isinstance(shape, TextShape) and shape.t != id:
+                    self.search_index.add(shape.t, node)
 
     def handle_edge(self, src_id, dst_id, attrs):
         try:
@@ -1066,21 +1598,53 @@ class XDotParser(DotParser):
         except KeyError:
             return
 
-        points = self.parse_edge_pos(pos)
-        shapes = []
-        for attr in ("_draw_", "_ldraw_", "_hdraw_", "_tdraw_", "_hldraw_", "_tldraw_"):
-            if attr in attrs:
-                parser = XDotAttrParser(self, attrs[attr])
-                shapes.extend(parser.parse())
+        signature = (self.xoffset, self.yoffset, pos) + tuple(
+            [attrs.get(attr) for attr in self.EDGE_DRAW_ATTRS])
+        previous = self.get_previous_edge(src_id, dst_id, signature)
+        if previous is not None:
+            points = previous.points
+            shapes = previous.shapes
+        else:
+            points = self.parse_edge_pos(pos)
+            shapes = []
+            for attr in self.EDGE_DRAW_ATTRS:
+                if attr in attrs:
+                    parser = XDotAttrParser(self, attrs[attr])
+                    shapes.extend(parser.parse())
         if shapes:
             src = self.node_by_name[src_id]
             dst = self.node_by_name[dst_id]
-            self.edges.append(Edge(src, dst, points, shapes))
+            edge = Edge(src, dst, points, shapes)
+            edge.signature = signature
+            if previous is not None:
+                edge.segments = previous.segments
+            src.out_edges.append(edge)
+            dst.in_edges.append(edge)
+            self.edges.append(edge)
+
+    EDGE_DRAW_ATTRS = ("_draw_", "_ldraw_", "_hdraw_", "_tdraw_",
+                       "_hldraw_", "_tldraw_")
+
+    def get_previous_edge(self, src_id, dst_id, signature):
+        """Take an edge of the previous layout drawn from the same
+        attributes, if there is one."""
+        if self.previous is None:
+            return None
+        if self.previous_edges is None:
+            self.previous_edges = index_edges(self.previous)
+        edges = self.previous_edges.get((src_id, dst_id, signature))
+        if edges:
+            return edges.pop(0)
+        return None
 
     def parse(self):
         DotParser.parse(self)
+        return self.get_graph()
 
-        return Graph(self.width, self.height, self.shapes, self.nodes, self.edges)
+    def get_graph(self):
+        return Graph(self.width, self.height, self.shapes, self.nodes,
+                     self.edges, self.node_by_name, self.search_index,
+                     (self.x, self.y))
 
     def parse_node_pos(self, pos):
         x, y = pos.split(",")
@@ -1106,10 +1670,1239 @@ class XDotParser(DotParser):
         return x, y
 
 
+def quote_id(text):
+    if isinstance(text, DotEndpoint):
+        port, compass_pt = text.port
+        text = quote_id(text.id)
+        if port is not None:
+            text += ':' + quote_id(port)
+        if compass_pt is not None:
+            text += ':' + compass_pt
+        return text
+    if isinstance(text, DotId):
+        return text.source
+    text = text.replace('"', '\\"')
+    text = text.replace('\n', '\\n')
+    text = text.replace('\r', '\\r')
+    return '"' + text + '"'
+
+
+def format_attrs(attrs):
+    if not attrs:
+        return ''
+    return ' [%s]' % ', '.join(['%s=%s' % (quote_id(name), quote_id(attrs[name]))
+                                for name in sorted(attrs)])
+
+
+class DotSubgraph(object):
+    """A subgraph of a DotGraph, and the ids of the nodes mentioned in it."""
+
+    def __init__(self, id=None):
+        self.id = id
+        self.attrs = {}
+        self.node_ids = []
+        self.members = set()
+        self.subgraphs = []
+
+    def add_node(self, id):
+        if id not in self.members:
+            self.members.add(id)
+            self.node_ids.append(id)
+
+    def is_cluster(self):
+        return self.id is not None and self.id.startswith('cluster')
+
+    def get_node_ids(self):
+        """Return the ids of the nodes in this subgraph or nested in it."""
+        node_ids = set(self.members)
+        for subgraph in self.subgraphs:
+            node_ids.update(subgraph.get_node_ids())
+        return node_ids
+
+
+class DotGraph(object):
+    """The nodes, edges, subgraphs and attributes of a DOT graph before
+    layout."""
+
+    def __init__(self, strict=False, directed=True):
+        self.strict = strict
+        self.directed = directed
+        self.attrs = {}
+        self.node_ids = []
+        self.node_attrs = {}
+        self.edges = []
+        self.subgraphs = []
+
+    def add_node(self, id, attrs):
+        try:
+            self.node_attrs[id].update(attrs)
+        except KeyError:
+            self.node_ids.append(id)
+            self.node_attrs[id] = dict(attrs)
+
+    def add_edge(self, src_id, dst_id, attrs):
+        self.edges.append((src_id, dst_id, attrs))
+
+    def iter_subgraphs(self):
+        """Walk all subgraphs, outer ones before those nested in them."""
+        stack = list(reversed(self.subgraphs))
+        while stack:
+            subgraph = stack.pop()
+            yield subgraph
+            stack.extend(reversed(subgraph.subgraphs))
+
+    def get_cluster_ids(self):
+        return [subgraph.id for subgraph in self.iter_subgraphs()
+                if subgraph.is_cluster()]
+
+    def get_cluster_of(self, id):
+        """Return the id of the innermost cluster holding node id, if any."""
+        cluster_id = None
+        for subgraph in self.iter_subgraphs():
+            if subgraph.is_cluster() and id in subgraph.members:
+                cluster_id = subgraph.id
+        return cluster_id
+
+    def get_neighborhood(self, id, hops):
+        """Return the ids of the nodes at most hops edges away from node id,
+        whichever the edge direction."""
+        if id not in self.node_attrs:
+            raise KeyError(id)
+        adjacency = {}
+        for src_id, dst_id, attrs in self.edges:
+            adjacency.setdefault(src_id, []).append(dst_id)
+            adjacency.setdefault(dst_id, []).append(src_id)
+        seen = set([id])
+        frontier = [id]
+        for hop in range(hops):
+            next_frontier = []
+            for node_id in frontier:
+                for neighbor_id in adjacency.get(node_id, ()):
+                    if neighbor_id not in seen:
+                        seen.add(neighbor_id)
+                        next_frontier.append(neighbor_id)
+            frontier = next_frontier
+        return seen
+
+    def get_layout_key(self):
+        """Return everything the layout depends on, leaving out the style
+        attributes that restyle_graph can apply to a laid out graph.
+
+        Only nodes and edges are restyled, so graph and cluster attributes
+        are all kept.
+        """
+        def key(attrs):
+            return sorted([(name, value) for name, value in attrs.iteritems()
+                           if not is_style_attr(name, value)])
+
+        def subgraph_key(subgraph):
+            return (subgraph.id, sorted(subgraph.attrs.items()),
+                    subgraph.node_ids,
+                    [subgraph_key(child) for child in subgraph.subgraphs])
+
+        return (self.strict, self.directed, sorted(self.attrs.items()),
+                [(id, key(self.node_attrs[id])) for id in self.node_ids],
+                [(src_id, get_port(src_id), dst_id, get_port(dst_id),
+                  key(attrs))
+                 for src_id, dst_id, attrs in self.edges],
+                [subgraph_key(subgraph) for subgraph in self.subgraphs])
+
+    def get_components(self):
+        """Return the node ids of each connected component, keeping the
+        nodes of a cluster together."""
+        parent = dict((id, id) for id in self.node_ids)
+
+        def find(id):
+            root = id
+            while parent[root] != root:
+                root = parent[root]
+            while parent[id] != root:
+                parent[id], id = root, parent[id]
+            return root
+
+        def union(a, b):
+            a = find(a)
+            b = find(b)
+            if a != b:
+                parent[a] = b
+
+        for src_id, dst_id, attrs in self.edges:
+            union(src_id, dst_id)
+        for subgraph in self.iter_subgraphs():
+            if subgraph.is_cluster():
+                # nested clusters count, even when they hold all the nodes
+                node_ids = list(subgraph.get_node_ids())
+                for id in node_ids[1:]:
+                    union(node_ids[0], id)
+
+        components = {}
+        roots = []
+        for id in self.node_ids:
+            root = find(id)
+            try:
+                components[root].append(id)
+            except KeyError:
+                components[root] = [id]
+                roots.append(root)
+        return [components[root] for root in roots]
+
+    def subgraph(self, node_ids):
+        """Return the graph induced by a set of node ids."""
+        graph = DotGraph(self.strict, self.directed)
+        graph.attrs = self.attrs
+        # subgraph members missing from the node list are not written out
+        graph.subgraphs = self.subgraphs
+        for id in self.node_ids:
+            if id in node_ids:
+                graph.add_node(id, self.node_attrs[id])
+        for src_id, dst_id, attrs in self.edges:
+            if src_id in node_ids and dst_id in node_ids:
+                graph.add_edge(src_id, dst_id, attrs)
+        return graph
+
+    def get_placeholder_ids(self, cluster_ids):
+        """Return the id of the node that fold replaces each cluster with:
+        the cluster's id, unless a node already has it."""
+        taken = set(self.node_attrs)
+        placeholder_ids = {}
+        for cluster_id in sorted(cluster_ids):
+            id = cluster_id
+            count = 1
+            while id in taken:
+                count += 1
+                id = '%s (%d)' % (cluster_id, count)
+            taken.add(id)
+            placeholder_ids[cluster_id] = id
+        return placeholder_ids
+
+    def fold(self, cluster_ids):
+        """Return a copy of the graph where each of the given clusters, and
+        whatever is nested in it, is replaced by a single placeholder node,
+        named as get_placeholder_ids tells."""
+        graph = DotGraph(self.strict, self.directed)
+        graph.attrs = self.attrs
+        placeholders = {}
+        graph.subgraphs = self.fold_subgraphs(
+            graph, self.subgraphs, None,
+            self.get_placeholder_ids(cluster_ids), placeholders)
+        for id in self.node_ids:
+            if id not in placeholders:
+                graph.add_node(id, self.node_attrs[id])
+
+        folded_edges = set()
+        for src_id, dst_id, attrs in self.edges:
+            if src_id not in placeholders and dst_id not in placeholders:
+                graph.add_edge(src_id, dst_id, attrs)
+                continue
+            src_id = placeholders.get(src_id, src_id)
+            dst_id = placeholders.get(dst_id, dst_id)
+            if src_id == dst_id or (src_id, dst_id) in folded_edges:
+                continue
+            folded_edges.add((src_id, dst_id))
+            graph.add_edge(src_id, dst_id, {})
+        return graph
+
+    def fold_subgraphs(self, graph, subgraphs, parent, placeholder_ids,
+                       placeholders):
+        result = []
+        for subgraph in subgraphs:
+            if subgraph.id in placeholder_ids:
+                placeholder_id = placeholder_ids[subgraph.id]
+                node_ids = subgraph.get_node_ids()
+                for id in node_ids:
+                    placeholders.setdefault(id, placeholder_id)
+                label = subgraph.attrs.get('label', subgraph.id)
+                graph.add_node(placeholder_id, {
+                    'label': '%s\n(%d nodes)' % (label, len(node_ids)),
+                    'shape': 'box3d',
+                    'style': 'filled',
+                    'fillcolor': 'lightgrey',
+                })
+                if parent is not None:
+                    parent.add_node(placeholder_id)
+                continue
+            copy = DotSubgraph(subgraph.id)
+            copy.attrs = subgraph.attrs
+            copy.node_ids = list(subgraph.node_ids)
+            copy.members = set(subgraph.members)
+            copy.subgraphs = self.fold_subgraphs(
+                graph, subgraph.subgraphs, copy, placeholder_ids,
+                placeholders)
+            result.append(copy)
+        return result
+
+    def to_dotcode(self):
+        """Write the graph back as DOT source.
+
+        >>> dotcode = DotGraphParser('digraph { a [shape=record, '
+        ...     'label="<p1> x|<p2> y"]; a:p1 -> a:p2:n; b -> a:p2 }'
+        ...     ).parse().to_dotcode()
+        >>> dotcode.splitlines()[3:5]
+        ['\\t"a":"p1" -> "a":"p2":n;', '\\t"b" -> "a":"p2";']
+        >>> DotGraphParser(dotcode).parse().to_dotcode() == dotcode
+        True
+        """
+        if self.directed:
+            graph_type, edge_op = 'digraph', '->'
+        else:
+            graph_type, edge_op = 'graph', '--'
+        if self.strict:
+            graph_type = 'strict ' + graph_type
+        lines = [graph_type + ' {']
+        if self.attrs:
+            lines.append('\tgraph%s;' % format_attrs(self.attrs))
+        for id in self.node_ids:
+            lines.append('\t%s%s;' % (quote_id(id),
+                                      format_attrs(self.node_attrs[id])))
+        for subgraph in self.subgraphs:
+            self.write_subgraph(lines, subgraph, '\t')
+        for src_id, dst_id, attrs in self.edges:
+            lines.append('\t%s %s %s%s;' % (quote_id(src_id), edge_op,
+                                            quote_id(dst_id),
+                                            format_attrs(attrs)))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def write_subgraph(self, lines, subgraph, indent):
+        if subgraph.id is None and not subgraph.attrs:
+            # a plain {...} group, e.g. an edge operand, means nothing once
+            # the edges are written out one by one
+            for child in subgraph.subgraphs:
+                self.write_subgraph(lines, child, indent)
+            return
+        # nodes were declared with their attributes at the top, so a
+        # subgraph only needs to name its members
+        body = []
+        for id in subgraph.node_ids:
+            if id in self.node_attrs:
+                body.append('%s\t%s;' % (indent, quote_id(id)))
+        for child in subgraph.subgraphs:
+            self.write_subgraph(body, child, indent + '\t')
+        if not body:
+            return
+        if subgraph.id is None:
+            lines.append(indent + 'subgraph {')
+        else:
+            lines.append('%ssubgraph %s {' % (indent, quote_id(subgraph.id)))
+        if subgraph.attrs:
+            lines.append('%s\tgraph%s;' % (indent, format_attrs(subgraph.attrs)))
+        lines.extend(body)
+        lines.append(indent + '}')
+
+
+class DotGraphParser(DotParser):
+    """Read DOT source into a DotGraph, without laying it out.
+
+    Default node and edge attributes are folded into every node and edge,
+    so that any part of the graph can be written back on its own.
+    """
+
+    def __init__(self, dotcode):
+        lexer = DotSourceLexer(buf=dotcode)
+        DotParser.__init__(self, lexer)
+        self.graph = DotGraph()
+        # DotSubgraph objects for the ids in subgraph_ids
+        self.subgraph_stack = []
+
+    def parse(self):
+        DotParser.parse(self)
+        return self.graph
+
+    def parse_graph(self):
+        if self.lookahead.type == STRICT:
+            self.graph.strict = True
+            self.consume()
+        self.graph.directed = self.lookahead.type == DIGRAPH
+        DotParser.parse_graph(self)
+
+    def get_subgraph(self):
+        """Return the DotSubgraph being parsed, or None at the top level."""
+        if not self.subgraph_ids:
+            return None
+        return self.subgraph_stack[len(self.subgraph_ids) - 1]
+
+    def handle_subgraph(self, id):
+        # subgraph_ids already holds this subgraph, the stack does not yet
+        depth = len(self.subgraph_ids)
+        del self.subgraph_stack[depth - 1:]
+        parent = self.subgraph_stack[-1] if self.subgraph_stack else None
+        siblings = self.graph.subgraphs if parent is None else parent.subgraphs
+        subgraph = None
+        if id is not None:
+            # statements of a repeated subgraph id add to the same subgraph
+            for sibling in siblings:
+                if sibling.id == id:
+                    subgraph = sibling
+        if subgraph is None:
+            subgraph = DotSubgraph(id)
+            siblings.append(subgraph)
+        self.subgraph_stack.append(subgraph)
+
+    def handle_graph(self, attrs):
+        subgraph = self.get_subgraph()
+        if subgraph is None:
+            self.graph.attrs.update(attrs)
+        else:
+            subgraph.attrs.update(attrs)
+
+    def add_node(self, id, attrs=None):
+        if id not in self.graph.node_attrs:
+            self.graph.add_node(id, self.node_attrs)
+        if attrs:
+            self.graph.add_node(id, attrs)
+        subgraph = self.get_subgraph()
+        if subgraph is not None:
+            subgraph.add_node(id)
+
+    def handle_port(self, id, port, compass_pt):
+        if port is None:
+            return id
+        # edges keep the ends they were written with
+        return DotEndpoint(id, port, compass_pt)
+
+    def handle_node(self, id, attrs):
+        self.add_node(getattr(id, 'id', id), attrs)
+
+    def handle_edge(self, src_id, dst_id, attrs):
+        self.add_node(getattr(src_id, 'id', src_id))
+        self.add_node(getattr(dst_id, 'id', dst_id))
+        edge_attrs = dict(self.edge_attrs)
+        edge_attrs.update(attrs)
+        self.graph.add_edge(src_id, dst_id, edge_attrs)
+
+
+class DotSplitter(object):
+    """Cut a stream of DOT text into whole graphs as it arrives.
+
+    Only strings, comments and HTML labels are told apart from the rest, to
+    find the brace that closes each graph.
+    """
+
+    token_re = re.compile(r'''
+          "(?:\\.|[^"\\])*(?P<quote>"?)
+        | /\*.*?(?P<star>\*/|\Z)
+        | (?://|^\#)[^\n]*(?P<newline>\n?)
+        | [^"/#{}<>]+
+        | .
+    ''', re.VERBOSE | re.DOTALL | re.MULTILINE)
+
+    def __init__(self):
+        self.buf = ''
+        self.pos = 0
+        self.depth = 0
+        self.html = 0
+        self.start = None
+
+    def feed(self, data):
+        """Add data and return the graphs it completed."""
+        self.buf += data
+        graphs = []
+        while self.pos < len(self.buf):
+            mo = self.token_re.match(self.buf, self.pos)
+            end = mo.end()
+            token = mo.group()
+            if (mo.group('quote') == '' or mo.group('star') == '' or
+                    mo.group('newline') == '' or
+                    (token == '/' and end == len(self.buf))):
+                # cut short by the end of the data so far
+                break
+            if self.start is None and not token.isspace():
+                self.start = self.pos + len(token) - len(token.lstrip())
+            if token == '<':
+                self.html += 1
+            elif token == '>' and self.html:
+                self.html -= 1
+            elif token == '{' and not self.html:
+                self.depth += 1
+            elif token == '}' and not self.html and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    graphs.append(self.buf[self.start:end])
+                    self.start = None
+            self.pos = end
+        # keep only the graph being read
+        cut = self.pos if self.start is None else self.start
+        self.buf = self.buf[cut:]
+        self.pos -= cut
+        if self.start is not None:
+            self.start -= cut
+        return graphs
+
+
+def is_complete(dotcode):
+    """Return whether dotcode ends outside of any graph, string, comment or
+    HTML label, so that more DOT read after it is taken as such.
+
+    >>> is_complete('digraph { a -> b }')
+    True
+    >>> is_complete('digraph { a [label="open] }')
+    False
+    >>> is_complete('digraph { a } /* open')
+    False
+    >>> is_complete('digraph { a [label=<<b>] }')
+    False
+    """
+    splitter = DotSplitter()
+    splitter.feed(dotcode)
+    return (splitter.start is None and splitter.pos == len(splitter.buf) and
+            not splitter.html)
+
+
+_graph_header_re = re.compile(
+    r'(?:strict\s+)?(?:di)?graph\s*("(?:\\.|[^"\\])*"|[^\s{]+)?\s*\{',
+    re.IGNORECASE)
+
+
+def split_graphs(text):
+    """Return the name and source of each top level graph in text.
+
+    Only braces, strings and comments are looked at, so this is much
+    cheaper than parsing the graphs.
+    """
+    graphs = []
+    for dotcode in DotSplitter().feed(text):
+        mo = _graph_header_re.search(dotcode)
+        name = mo and mo.group(1)
+        if not name:
+            name = 'graph %d' % (len(graphs) + 1)
+        elif name.startswith('"'):
+            name = name[1:-1].replace('\\"', '"')
+        graphs.append((name, dotcode))
+    return graphs
+
+
+class LayoutError(Exception):
+    pass
+
+
+class LayoutTimeout(LayoutError):
+    pass
+
+
+GRAPHVIZ_MISSING = ('qdot.py depends on Graphviz. Please install it on your '
+                    'system. More information on Graphviz '
+                    '(http://www.graphviz.org/)')
+
+
+def run_filter(filter, dotcode, timeout=None):
+    """Lay out dotcode with a graphviz filter and return the xdot code.
+
+    The filter is killed if it takes longer than timeout seconds.
+    """
+    try:
+        p = subprocess.Popen(
+            [filter, '-Txdot'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False,
+            universal_newlines=True
+        )
+    except OSError:
+        if find_program(filter) is None:
+            raise LayoutError(GRAPHVIZ_MISSING)
+        raise
+    expired = []
+    if timeout is not None:
+        def kill():
+            expired.append(True)
+            try:
+                p.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        xdotcode, error = p.communicate(dotcode)
+    finally:
+        if timeout is not None:
+            timer.cancel()
+    if expired:
+        raise LayoutTimeout('%s timed out' % filter)
+    if p.returncode != 0:
+        raise LayoutError(error)
+    return xdotcode
+
+
+class FilterProcess(object):
+    """A graphviz filter kept running to lay out one graph after another.
+
+    Each graph is followed by an empty sentinel graph, whose output marks
+    the end of the layout on the filter's stdout.
+    """
+
+    SENTINEL = '__qdot_sentinel__'
+    PROBE_TIMEOUT = 5.0
+
+    def __init__(self, filter):
+        self.filter = filter
+        self.process = subprocess.Popen(
+            [filter, '-Txdot'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False,
+            close_fds=True
+        )
+        # make sure the filter answers before relying on it
+        self.run('', self.PROBE_TIMEOUT)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, dotcode, timeout=None):
+        """Lay out dotcode and return the xdot code.
+
+        Raises LayoutError if the filter fails, after which the process is
+        closed.
+        """
+        data = dotcode + '\ndigraph %s {}\n' % self.SENTINEL
+        try:
+            output, error = self.communicate(data, timeout)
+        except LayoutError:
+            self.close()
+            raise
+        end = output.find('digraph ' + self.SENTINEL)
+        if end == -1:
+            self.close()
+            raise LayoutError(error)
+        if dotcode and not output[:end].strip():
+            # the filter reported an error and went on to the sentinel
+            raise LayoutError(error or '%s produced no layout' % self.filter)
+        return output[:end]
+
+    def communicate(self, data, timeout):
+        stdin = self.process.stdin.fileno()
+        stdout = self.process.stdout.fileno()
+        stderr = self.process.stderr.fileno()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        output = []
+        error = []
+        tail = ''
+        while True:
+            writers = data and [stdin] or []
+            if timeout is None:
+                ready = select.select([stdout, stderr], writers, [])
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise LayoutTimeout('%s timed out' % self.filter)
+                ready = select.select([stdout, stderr], writers, [], remaining)
+            readable, writable = ready[0], ready[1]
+            if writable:
+                try:
+                    written = os.write(stdin, data[:select.PIPE_BUF])
+                except OSError, ex:
+                    raise LayoutError(''.join(error) or str(ex))
+                data = data[written:]
+            if stderr in readable:
+                error.append(os.read(stderr, 4096))
+            if stdout in readable:
+                chunk = os.read(stdout, 65536)
+                if not chunk:
+                    # the filter exited, most likely on a syntax error
+                    self.process.wait()
+                    error.append(self.process.stderr.read())
+                    raise LayoutError(''.join(error))
+                output.append(chunk)
+                # the sentinel's layout is complete once its closing brace
+                # is seen
+                tail = (tail + chunk)[-len(self.SENTINEL) - 4096:]
+                if self.SENTINEL in tail and tail.endswith('}\n'):
+                    return ''.join(output), ''.join(error)
+
+    def close(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout,
+                     self.process.stderr):
+            pipe.close()
+        self.process = None
+
+
+class FilterPool(object):
+    """Filter processes kept around between layouts.
+
+    Dead processes are replaced on the next layout, and filters that cannot
+    be kept running fall back to a new process per layout.
+    """
+
+    def __init__(self, size=None):
+        # at most this many idle processes per filter, one per CPU if None
+        self.size = size
+        self.idle = {}
+        self.broken = set()
+        self.lock = threading.Lock()
+
+    def run(self, filter, dotcode, timeout=None):
+        """Lay out dotcode with filter and return the xdot code."""
+        # the sentinel of source that does not end cleanly would be read as
+        # part of it, and the filter would wait for more
+        worker = is_complete(dotcode) and self.acquire(filter) or None
+        if worker is None:
+            return run_filter(filter, dotcode, timeout)
+        try:
+            xdotcode = worker.run(dotcode, timeout)
+        except LayoutError:
+            # closed by run unless the filter is still in step
+            self.release(worker)
+            raise
+        except:
+            # whatever the filter is in the middle of, it can not be reused
+            worker.close()
+            raise
+        self.release(worker)
+        return xdotcode
+
+    def acquire(self, filter):
+        if os.name != 'posix' or filter in self.broken:
+            return None
+        with self.lock:
+            workers = self.idle.get(filter, [])
+            while workers:
+                worker = workers.pop()
+                if worker.is_alive():
+                    return worker
+                worker.close()
+        try:
+            return FilterProcess(filter)
+        except (OSError, LayoutError):
+            with self.lock:
+                self.broken.add(filter)
+            return None
+
+    def release(self, worker):
+        if self.size is None:
+            import multiprocessing
+            self.size = multiprocessing.cpu_count()
+        with self.lock:
+            workers = self.idle.setdefault(worker.filter, [])
+            if worker.is_alive() and len(workers) < self.size:
+                workers.append(worker)
+                return
+        worker.close()
+
+    def close(self):
+        with self.lock:
+            for workers in self.idle.values():
+                for worker in workers:
+                    worker.close()
+            self.idle = {}
+
+
+filter_pool = FilterPool()
+atexit.register(filter_pool.close)
+
+
+class GraphvizLibrary(object):
+    """Layout in process with libgvc and libcgraph, through ctypes.
+
+    The laid out graph is rendered to xdot without an output file, which
+    only attaches the xdot attributes to the graph, and these are fed to an
+    XDotParser directly. Graphviz is not thread safe, so layouts are
+    serialized.
+    """
+
+    GRAPH_ATTRS = ('bb', '_draw_', '_ldraw_')
+    NODE_ATTRS = ('pos', 'width', 'height', 'URL', '_draw_', '_ldraw_')
+    EDGE_ATTRS = ('pos', '_draw_', '_ldraw_', '_hdraw_', '_tdraw_',
+                  '_hldraw_', '_tldraw_')
+
+    def __init__(self):
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Return whether the libraries are available."""
+        if self.loaded is None:
+            try:
+                self._load()
+            except (OSError, AttributeError):
+                self.loaded = False
+            else:
+                self.loaded = True
+        return self.loaded
+
+    def _load(self):
+        import ctypes
+        import ctypes.util
+        gvc_path = ctypes.util.find_library('gvc')
+        cgraph_path = ctypes.util.find_library('cgraph')
+        if gvc_path is None or cgraph_path is None:
+            raise OSError('libgvc not found')
+        cgraph = ctypes.CDLL(cgraph_path)
+        gvc = ctypes.CDLL(gvc_path)
+
+        pointer = ctypes.c_void_p
+        string = ctypes.c_char_p
+        for lib, name, restype, argtypes in (
+            (cgraph, 'agmemread', pointer, [string]),
+            (cgraph, 'agclose', ctypes.c_int, [pointer]),
+            (cgraph, 'agfstnode', pointer, [pointer]),
+            (cgraph, 'agnxtnode', pointer, [pointer, pointer]),
+            (cgraph, 'agfstout', pointer, [pointer, pointer]),
+            (cgraph, 'agnxtout', pointer, [pointer, pointer]),
+            (cgraph, 'aghead', pointer, [pointer]),
+            (cgraph, 'agfstsubg', pointer, [pointer]),
+            (cgraph, 'agnxtsubg', pointer, [pointer]),
+            (cgraph, 'agnameof', string, [pointer]),
+            (cgraph, 'agget', string, [pointer, string]),
+            (cgraph, 'aglasterr', string, []),
+            (gvc, 'gvContext', pointer, []),
+            (gvc, 'gvLayout', ctypes.c_int, [pointer, pointer, string]),
+            (gvc, 'gvRender', ctypes.c_int,
+             [pointer, pointer, string, pointer]),
+            (gvc, 'gvFreeLayout', ctypes.c_int, [pointer, pointer]),
+        ):
+            function = getattr(lib, name)
+            function.restype = restype
+            function.argtypes = argtypes
+            setattr(self, name, function)
+        self.context = self.gvContext()
+
+    def layout(self, engine, dotcode, previous=None):
+        """Lay out dotcode with the given engine and return a Graph."""
+        with self.lock:
+            g = self.agmemread(dotcode)
+            if not g:
+                raise LayoutError(self.aglasterr() or 'syntax error')
+            try:
+                if self.gvLayout(self.context, g, engine) != 0:
+                    raise LayoutError('%s layout failed' % engine)
+                try:
+                    self.gvRender(self.context, g, 'xdot', None)
+                    return self.read_graph(g, previous)
+                finally:
+                    self.gvFreeLayout(self.context, g)
+            finally:
+                self.agclose(g)
+
+    def get_attrs(self, obj, names):
+        attrs = {}
+        for name in names:
+            value = self.agget(obj, name)
+            if value is not None:
+                attrs[name] = value
+        return attrs
+
+    def read_graph(self, g, previous=None):
+        parser = XDotParser('', previous=previous)
+        parser.handle_graph(self.get_attrs(g, self.GRAPH_ATTRS))
+        stack = [g]
+        while stack:
+            subg = self.agfstsubg(stack.pop())
+            while subg:
+                parser.handle_graph(self.get_attrs(subg, self.GRAPH_ATTRS))
+                stack.append(subg)
+                subg = self.agnxtsubg(subg)
+
+        n = self.agfstnode(g)
+        while n:
+            parser.handle_node(self.agnameof(n),
+                               self.get_attrs(n, self.NODE_ATTRS))
+            n = self.agnxtnode(g, n)
+        n = self.agfstnode(g)
+        while n:
+            e = self.agfstout(g, n)
+            while e:
+                parser.handle_edge(self.agnameof(n),
+                                   self.agnameof(self.aghead(e)),
+                                   self.get_attrs(e, self.EDGE_ATTRS))
+                e = self.agnxtout(g, e)
+            n = self.agnxtnode(g, n)
+        return parser.get_graph()
+
+
+graphviz_library = GraphvizLibrary()
+
+
+# attributes that change how a laid out graph is painted but not the layout
+COLOR_ATTRS = ('color', 'fillcolor', 'fontcolor', 'pencolor', 'bgcolor')
+STYLE_ATTRS = COLOR_ATTRS + ('penwidth', 'URL', 'href', 'tooltip')
+
+
+def is_style_attr(name, value):
+    if name in COLOR_ATTRS:
+        # color lists split edges and fills, which takes a layout
+        return parse_color(value) is not None
+    if name == 'penwidth':
+        try:
+            float(value)
+        except ValueError:
+            return False
+    return name in STYLE_ATTRS
+
+
+def get_style(attrs):
+    return dict([(name, value) for name, value in attrs.iteritems()
+                 if is_style_attr(name, value)])
+
+
+def restyle_element(element, attrs, fillcolor):
+    """Repaint the shapes of a node or edge for new style attributes."""
+    color = parse_color(attrs.get('color', 'black'))
+    fillcolor = parse_color(attrs.get('fillcolor', fillcolor))
+    fontcolor = parse_color(attrs.get('fontcolor', 'black'))
+    for shape in element.shapes:
+        pen = shape.pen
+        if isinstance(shape, TextShape):
+            pen.set_color(fontcolor)
+        else:
+            pen.set_color(color)
+            pen.set_fillcolor(fillcolor)
+            if 'penwidth' in attrs:
+                pen.linewidth = float(attrs['penwidth'])
+            else:
+                pen.linewidth = Pen().linewidth
+        if hasattr(shape, 'highlight_pen'):
+            del shape.highlight_pen
+    url = attrs.get('URL', attrs.get('href'))
+    if isinstance(element, Node):
+        element.url = url
+    # the shapes no longer match the xdot attributes they came from
+    element.signature = None
+
+
+def restyle_graph(graph, old, new):
+    """Apply the style changes from DotGraph old to DotGraph new to the
+    laid out graph, if nothing else changed.
+
+    Returns whether it could, otherwise a new layout is needed.
+    """
+    if old.get_layout_key() != new.get_layout_key():
+        return False
+
+    changed_nodes = []
+    for id in new.node_ids:
+        attrs = get_style(new.node_attrs[id])
+        if attrs != get_style(old.node_attrs[id]):
+            node = graph.node_by_name.get(id)
+            if node is None:
+                return False
+            changed_nodes.append((node, attrs))
+
+    # match parallel edges in order
+    edges_by_ends = {}
+    for edge in graph.edges:
+        edges_by_ends.setdefault((edge.src.id, edge.dst.id), []).append(edge)
+    changed_edges = []
+    count = {}
+    for (src_id, dst_id, attrs), (_, _, old_attrs) in zip(new.edges,
+                                                          old.edges):
+        ends = (src_id, dst_id)
+        i = count.get(ends, 0)
+        count[ends] = i + 1
+        attrs = get_style(attrs)
+        if attrs != get_style(old_attrs):
+            try:
+                edge = edges_by_ends[ends][i]
+            except (KeyError, IndexError):
+                return False
+            changed_edges.append((edge, attrs))
+
+    for node, attrs in changed_nodes:
+        restyle_element(node, attrs,
+                        attrs.get('color', 'lightgrey'))
+    for edge, attrs in changed_edges:
+        restyle_element(edge, attrs, attrs.get('color', 'black'))
+    return True
+
+
+# above these estimated sizes dot takes too long, see choose_filter
+LARGE_NODES = 2000
+LARGE_EDGES = 5000
+
+
+def _build_prescan_re():
+    skip = []
+    ids = []
+    edge_ops = []
+    quoted = []
+    for type, regexp, test_lit in DotScanner.tokens:
+        {SKIP: skip, EDGE_OP: edge_ops}.get(type, ids).append(regexp)
+        if type in (STR_ID, HTML_ID):
+            quoted.append(regexp)
+    # whitespace and comments are matched along with the token after them,
+    # and attribute lists as a whole
+    return re.compile('(?:%s)*(?:(%s)|(%s)|(\\[(?:%s|[^]"<])*\\])|(.)|$)' % (
+        '|'.join(skip), '|'.join(ids), '|'.join(edge_ops),
+        '|'.join(quoted)), re.DOTALL)
+
+_prescan_re = _build_prescan_re()
+
+
+def estimate_size(dotcode):
+    """Return rough node and edge counts of dotcode, from its tokens alone.
+
+    Edges are counted by their edge operators, and nodes are the distinct
+    ids that are neither attributes nor graph names.
+    """
+    node_ids = set()
+    edges = 0
+    pending = None
+    after = None
+    for mo in _prescan_re.finditer(dotcode):
+        kind = mo.lastindex
+        if kind is None:
+            continue
+        text = mo.group(kind)
+        if pending is not None:
+            if kind != 4 or text != '=':
+                node_ids.add(pending)
+            pending = None
+        if kind == 1:
+            keyword = text.lower()
+            if keyword in DotScanner.literals:
+                after = keyword
+                continue
+            if after not in ('=', ':', 'graph', 'digraph', 'subgraph'):
+                pending = text.strip('"')
+        elif kind == 2:
+            edges += 1
+        elif kind == 4:
+            after = text
+            continue
+        after = None
+    if pending is not None:
+        node_ids.add(pending)
+    return len(node_ids), edges
+
+
+def choose_filter(filter, dotcode, limits=None):
+    """Return the filter to lay out dotcode with, and a warning or None.
+
+    'auto' stands for dot unless the graph looks too large for it, in which
+    case sfdp is used. Other filters are kept as they are, without a scan of
+    the source.
+    """
+    if filter != 'auto':
+        return filter, None
+    if limits is None:
+        limits = (LARGE_NODES, LARGE_EDGES)
+    nodes, edges = estimate_size(dotcode)
+    if nodes <= limits[0] and edges <= limits[1]:
+        return 'dot', None
+    size = 'about %d nodes and %d edges' % (nodes, edges)
+    if find_program('sfdp') is None:
+        return 'dot', 'Large graph (%s), but sfdp is not installed' % size
+    return 'sfdp', 'Large graph (%s), laid out with sfdp' % size
+
+
+# filters that take pos attributes as the starting point of their layout
+WARM_START_FILTERS = ('neato', 'fdp', 'sfdp')
+
+
+def add_position_hints(dotcode, graph):
+    """Return dotcode with the node positions of a previous layout as pos
+    attributes, so an iterative layout can start from there."""
+    dotgraph = DotGraphParser(dotcode).parse()
+    # pos values are divided by inputscale to get inches
+    try:
+        scale = float(dotgraph.attrs.get('inputscale', 1))
+    except ValueError:
+        scale = 1.0
+    if scale <= 0:
+        scale = 72.0
+    for id in dotgraph.node_ids:
+        node = graph.node_by_name.get(id)
+        attrs = dotgraph.node_attrs[id]
+        if node is not None and 'pos' not in attrs:
+            attrs['pos'] = '%f,%f' % (node.x / 72 * scale,
+                                      -node.y / 72 * scale)
+    return dotgraph.to_dotcode()
+
+
+def layout_graph(filter, dotcode, library=False, previous=None,
+                 timeout=None):
+    """Lay out dotcode into a Graph, in process when asked for and libgvc is
+    available, with a filter process otherwise.
+
+    A layout in process can not be interrupted, so a timeout always takes a
+    filter process.
+    """
+    if library and timeout is None and graphviz_library.load():
+        return graphviz_library.layout(filter, dotcode, previous)
+    xdotcode = filter_pool.run(filter, dotcode, timeout)
+    return XDotParser(xdotcode, previous=previous).parse()
+
+
+# cheaper settings to retry a layout with when it runs out of time, each
+# step on top of the ones before
+LAYOUT_DEGRADATIONS = (
+    ('fewer iterations', None,
+     {'nslimit': '2', 'nslimit1': '2', 'mclimit': '0.2', 'maxiter': '100'}),
+    ('straight edges', None, {'splines': 'line'}),
+    ('sfdp', 'sfdp', {}),
+)
+
+
+def degrade_layout(layout, filter, dotcode, budget=None):
+    """Call layout(filter, dotcode, timeout=budget), and retry with the
+    steps of LAYOUT_DEGRADATIONS for as long as it times out.
+
+    Each attempt gets the whole budget. Returns the Graph and a note about
+    the degradation applied, or None.
+    """
+    try:
+        return layout(filter, dotcode, timeout=budget), None
+    except LayoutTimeout:
+        pass
+    dotgraph = DotGraphParser(dotcode).parse()
+    applied = []
+    for description, engine, attrs in LAYOUT_DEGRADATIONS:
+        if engine is not None:
+            if engine == filter or find_program(engine) is None:
+                continue
+            filter = engine
+        dotgraph.attrs.update(attrs)
+        applied.append(description)
+        try:
+            graph = layout(filter, dotgraph.to_dotcode(), timeout=budget)
+        except LayoutTimeout:
+            continue
+        return graph, 'Layout took over %gs, retried with %s' % (
+            budget, ', '.join(applied))
+    raise LayoutTimeout('Layout took over %gs, even with %s' % (
+        budget, ', '.join(applied)))
+
+
+_bb_re = re.compile(r'\bbb\s*=\s*"([^"]*)"')
+
+
+def get_bounding_box(xdotcode):
+    """Return the width and height of the top graph of xdotcode without
+    parsing it; its bb comes before any subgraph's."""
+    mo = _bb_re.search(xdotcode)
+    if mo is None:
+        return 0.0, 0.0
+    xmin, ymin, xmax, ymax = map(float, mo.group(1).split(','))
+    return xmax - xmin, ymax - ymin
+
+
+def pack_boxes(sizes, margin):
+    """Place boxes on shelves of a roughly square area, tallest first.
+
+    Returns the top left corner of each box and the size of the whole.
+    """
+    if not sizes:
+        return [], 0.0, 0.0
+    area = sum([(w + margin) * (h + margin) for w, h in sizes])
+    max_width = max(max([w for w, h in sizes]), math.sqrt(area))
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    origins = [None] * len(sizes)
+    x = y = 0.0
+    shelf_height = 0.0
+    width = 0.0
+    for i in order:
+        w, h = sizes[i]
+        if x > 0 and x + w > max_width:
+            y += shelf_height + margin
+            x = 0.0
+            shelf_height = 0.0
+        origins[i] = (x, y)
+        width = max(width, x + w)
+        shelf_height = max(shelf_height, h)
+        x += w + margin
+    return origins, width, y + shelf_height
+
+
+def pack_xdotcodes(xdotcodes, margin=16, previous=None):
+    """Parse the xdot code of several graphs into a single Graph with the
+    graphs side by side, as gvpack does."""
+    sizes = [get_bounding_box(xdotcode) for xdotcode in xdotcodes]
+    origins, width, height = pack_boxes(sizes, margin)
+    graph = Graph(width, height, [], [], [])
+    previous_edges = None
+    if previous is not None:
+        previous_edges = index_edges(previous)
+    for xdotcode, origin in zip(xdotcodes, origins):
+        part = XDotParser(xdotcode, origin, previous, previous_edges).parse()
+        graph.shapes.extend(part.shapes)
+        graph.nodes.extend(part.nodes)
+        graph.edges.extend(part.edges)
+        graph.node_by_name.update(part.node_by_name)
+        graph.search_index.extend(part.search_index)
+    return graph
+
+
+# graph attributes that make no sense repeated for every component
+COMPONENT_SKIP_ATTRS = ('size', 'ratio', 'page', 'label')
+
+
+def layout_components(filter, dotcode, processes=None, previous=None,
+                      timeout=None):
+    """Lay out each connected component of dotcode in its own filter
+    process, several at a time, and pack the results into one Graph.
+
+    The timeout is for all of the components together.
+    """
+    start = time.time()
+    graph = DotGraphParser(dotcode).parse()
+    components = graph.get_components()
+    if len(components) <= 1:
+        return layout_graph(filter, dotcode, previous=previous,
+                            timeout=timeout)
+    dotcodes = []
+    for node_ids in components:
+        component = graph.subgraph(set(node_ids))
+        component.attrs = dict(component.attrs)
+        for name in COMPONENT_SKIP_ATTRS:
+            component.attrs.pop(name, None)
+        dotcodes.append(component.to_dotcode())
+    split_time = time.time()
+
+    import multiprocessing
+    import multiprocessing.pool
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    def layout(code):
+        if timeout is None:
+            return filter_pool.run(filter, code)
+        remaining = start + timeout - time.time()
+        if remaining <= 0:
+            raise LayoutTimeout('%s timed out' % filter)
+        return filter_pool.run(filter, code, remaining)
+
+    # the work is done by the filter processes, threads only wait on them
+    pool = multiprocessing.pool.ThreadPool(min(processes, len(dotcodes)))
+    try:
+        xdotcodes = pool.map(layout, dotcodes)
+    finally:
+        pool.close()
+    layout_time = time.time()
+
+    graph = pack_xdotcodes(xdotcodes, previous=previous)
+    pack_time = time.time()
+    sys.stderr.write(
+        '%d components: split %.3fs, layout %.3fs, pack %.3fs\n' % (
+            len(components), split_time - start, layout_time - split_time,
+            pack_time - layout_time))
+    return graph
+
+
 class QDotWidget(QtGui.QGraphicsView):
     """PyQT widget that draws dot graphs."""
     graph = None
 
+    # id of a node that was double clicked
+    node_activated = QtCore.pyqtSignal(object)
+    # a note about how the last graph was laid out
+    layout_message = QtCore.pyqtSignal(str)
+
+    IDLE_DELAY = 150  # ms without panning or zooming before a full repaint
+    HOVER_INTERVAL = 16  # ms, about one frame
+
+    QUALITY_HINTS = (QtGui.QPainter.Antialiasing |
+                     QtGui.QPainter.TextAntialiasing)
+    DRAFT_HINTS = QtGui.QPainter.RenderHints()
+
     def __init__(self, parent=None):
         QtGui.QGraphicsView.__init__(self)
         self._scene = QtGui.QGraphicsScene(self)
@@ -1119,89 +2912,427 @@ class QDotWidget(QtGui.QGraphicsView):
 
         self.setDragMode(self.ScrollHandDrag)
         self.setTransformationAnchor(self.AnchorUnderMouse)
+        self.setRenderHints(self.QUALITY_HINTS)
 
         self.x, self.y = 0.0, 0.0
         #self.zoom_ratio = 1.0
+        self.filter = 'dot'
+        # graphs with more nodes or edges are laid out with sfdp in auto mode
+        self.size_limits = (LARGE_NODES, LARGE_EDGES)
+        # seconds a layout may take before it is retried with cheaper
+        # settings, no limit if None
+        self.layout_budget = None
+        self.components = False
+        self.library = False
+        self.warm_start = False
+        self.openfilename = None
+        # the source of the current layout, to tell style only changes
+        self.dotcode = None
+        # called after each paint with whether there was a graph to paint
+        self.paint_hook = None
+        self.layout_changed = False
         self.zoom_to_fit_on_resize = False
         self.animation = NoAnimation(self)
         self.presstime = None
         self.highlight = None
-
-    def set_dotcode(self, dotcode, filename='<stdin>'):
+        self.draft_level = 0
+        self.dragging = False
+        self.current_node = None
+        self.neighbor = None
+        self.neighbor_index = None
+
+        self.idle_timer = QtCore.QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(self.IDLE_DELAY)
+        self.idle_timer.timeout.connect(self.end_draft)
+
+        self.viewport().setMouseTracking(True)
+        self.hover_timer = QtCore.QTimer(self)
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.setInterval(self.HOVER_INTERVAL)
+        self.hover_timer.timeout.connect(self.on_hover)
+        self.hover_pos = None
+        self.hover_key = None
+
+    def set_dotcode(self, dotcode, filename='<stdin>', quiet=False):
+        """Lay out and show dotcode.  Errors are shown in a dialog or, if
+        quiet, only through layout_message."""
         if isinstance(dotcode, unicode):
             dotcode = dotcode.encode('utf8')
-        p = subprocess.Popen(
-            [self.filter, '-Txdot'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=False,
-            universal_newlines=True
-        )
-        xdotcode, error = p.communicate(dotcode)
-        if p.returncode != 0:
-            mbox = QtGui.QMessageBox()
-            mbox.setWindowTitle('QDot Viewer')
-            mbox.setText('Error: ' + error)
-            mbox.exec_()
-            return False
+        if filename == self.openfilename and self.restyle(dotcode):
+            self.dotcode = dotcode
+            self.layout_changed = False
+            self.viewport().update()
+            return True
+        source = dotcode
         try:
-            self.set_xdotcode(xdotcode)
-        except ParseError, ex:
+            filter, message = choose_filter(self.filter, dotcode,
+                                            self.size_limits)
+            if message is not None:
+                sys.stderr.write(message + '\n')
+                self.layout_message.emit(message)
+            if (self.warm_start and self.graph is not None and
+                    filename == self.openfilename and
+                    filter in WARM_START_FILTERS):
+                dotcode = add_position_hints(dotcode, self.graph)
+            if self.components:
+                def layout(filter, dotcode, timeout):
+                    return layout_components(filter, dotcode,
+                                             previous=self.graph,
+                                             timeout=timeout)
+            else:
+                def layout(filter, dotcode, timeout):
+                    return layout_graph(filter, dotcode, self.library,
+                                        self.graph, timeout)
+            graph, message = degrade_layout(layout, filter, dotcode,
+                                            self.layout_budget)
+            if message is not None:
+                sys.stderr.write(message + '\n')
+                self.layout_message.emit(message)
+        except (LayoutError, ParseError), ex:
+            if quiet:
+                self.layout_message.emit('Error: ' + str(ex))
+                return False
             mbox = QtGui.QMessageBox(self)
             mbox.setWindowTitle('QDot Viewer')
             mbox.setText('Error: ' + str(ex))
             mbox.exec_()
             return False
         else:
+            self.set_graph(graph)
+            self.dotcode = source
+            self.layout_changed = True
             self.openfilename = filename
             return True
 
+    def restyle(self, dotcode):
+        """Apply dotcode to the current layout if it only changes styles,
+        and return whether it did."""
+        if self.dotcode is None or self.graph is None:
+            return False
+        if dotcode == self.dotcode:
+            return True
+        try:
+            old = DotGraphParser(self.dotcode).parse()
+            new = DotGraphParser(dotcode).parse()
+        except ParseError:
+            return False
+        return restyle_graph(self.graph, old, new)
+
     def set_xdotcode(self, xdotcode):
-        parser = XDotParser(xdotcode)
-        self.graph = parser.parse()
-        (w, h) = self.graph.get_size()
-        self._scene = QtGui.QGraphicsScene(self)
-        self._scene.setSceneRect(QtCore.QRectF(0, 0, w, h))
-        self.setScene(self._scene)
+        parser = XDotParser(xdotcode, previous=self.graph)
+        self.set_graph(parser.parse())
+        self.dotcode = None
+        self.layout_changed = True
+
+    def set_graph(self, graph):
+        self.graph = graph
+        self.current_node = None
+        self.neighbor = None
+        # the graph is painted in drawForeground, so the scene only gives
+        # the extent and is kept
+        (x, y, w, h) = self.graph.get_rect()
+        self._scene.setSceneRect(QtCore.QRectF(x, y, w, h))
+        self.viewport().update()
 
         self.resize(w, h)
 
         #self.zoom_image(self.zoom_ratio, center=True)
 
     def zoom_image(self, zoom_ratio, center=False, pos=None):
-        self.scale(zoom_ratio, zoom_ratio)
+        target_zoom = self.get_zoom_ratio()
+        if isinstance(self.animation, ZoomAnimation):
+            # keep zooming from where the running animation was heading
+            target_zoom = self.animation.target_zoom
+        self.animation.stop()
+        self.animation = ZoomAnimation(self, target_zoom * zoom_ratio, pos)
+        self.animation.start()
+
+    def animate_to(self, x, y):
+        self.animation.stop()
+        self.animation = ZoomToAnimation(self, x, y)
+        self.animation.start()
+
+    def get_current_pos(self):
+        center = self.mapToScene(self.viewport().rect().center())
+        return center.x(), center.y()
+
+    def get_zoom_ratio(self):
+        return self.transform().m11()
+
+    def set_view(self, x, y, zoom_ratio):
+        """Center the view on graph point (x, y) at the given zoom ratio."""
+        self.setTransform(QtGui.QTransform.fromScale(zoom_ratio, zoom_ratio))
+        self.centerOn(x, y)
+
+    def interact(self):
+        """Note a pan or zoom step.
+
+        Painting stays in draft mode while these keep coming and returns to
+        full quality, with a single repaint, once they stop for IDLE_DELAY.
+        """
+        if not self.idle_timer.isActive():
+            self.begin_draft()
+        self.idle_timer.start()
+
+    def begin_draft(self):
+        """Paint without antialiasing and text until end_draft()."""
+        self.draft_level += 1
+        if self.draft_level == 1:
+            self.setRenderHints(self.DRAFT_HINTS)
+
+    def end_draft(self):
+        self.draft_level -= 1
+        if self.draft_level == 0:
+            self.setRenderHints(self.QUALITY_HINTS)
 
     def zoom_to_area(self, x1, y1, x2, y2):
+        self.animation.stop()
         self.fitInView(QtCore.QRectF(x1, y1, x2, y2), QtCore.Qt.KeepAspectRatio)
 
     def zoom_to_fit(self):
+        self.animation.stop()
         rectf = self._scene.sceneRect()
         self.fitInView(rectf, QtCore.Qt.KeepAspectRatio)
 
     def zoom_cancel(self):
+        self.animation.stop()
         self.resetTransform()
         #self.zoom_ratio = 1.0
 
     def set_filter(self, filter):
         self.filter = filter
+        # the same source needs a new layout
+        self.dotcode = None
+
+    def set_size_limits(self, nodes, edges):
+        self.size_limits = (nodes, edges)
+        self.dotcode = None
+
+    def set_layout_budget(self, budget):
+        """Retry layouts that take longer than budget seconds with cheaper
+        settings."""
+        self.layout_budget = budget
+        self.dotcode = None
+
+    def set_components(self, components):
+        """Lay out connected components separately and concurrently."""
+        self.components = components
+        self.dotcode = None
+
+    def set_library(self, library):
+        """Lay out in process with libgvc when it is available."""
+        self.library = library
+        self.dotcode = None
+
+    def set_warm_start(self, warm_start):
+        """Start the layout of a reloaded graph from the current positions,
+        for filters that support it."""
+        self.warm_start = warm_start
+        self.dotcode = None
+
+    def invalidate(self):
+        """Lay out the next graph even if only its styles changed."""
+        self.dotcode = None
+
+    def set_highlight(self, items):
+        if self.highlight != items:
+            self.highlight = items
+            self.viewport().update()
+
+    def on_hover(self):
+        if self.graph is None or self.dragging:
+            return
+        pos = self.mapToScene(self.hover_pos)
+        x, y = pos.x(), pos.y()
+        if self.hover_key is not None:
+            graph, hx, hy = self.hover_key
+            if graph is self.graph and abs(x - hx) < 1 and abs(y - hy) < 1:
+                return
+        self.hover_key = self.graph, x, y
+
+        url = self.graph.get_url(x, y)
+        item = url
+        if item is None:
+            item = self.graph.get_jump(x, y)
+        if item is not None:
+            self.viewport().setCursor(QtCore.Qt.PointingHandCursor)
+            self.set_highlight(item.highlight)
+        else:
+            self.viewport().setCursor(QtCore.Qt.OpenHandCursor)
+            self.set_highlight(None)
+        if url is not None:
+            QtGui.QToolTip.showText(
+                self.viewport().mapToGlobal(self.hover_pos), url.url,
+                self.viewport())
+        else:
+            QtGui.QToolTip.hideText()
 
     def drawForeground(self, painter, rect):
         if self.graph:
-            self.graph.draw(self._scene, painter, rect)
+            self.graph.draw(self._scene, painter, rect,
+                            highlight_items=self.highlight,
+                            draft=self.draft_level > 0)
+        if self.paint_hook is not None:
+            self.paint_hook(self.graph is not None)
+
+    def scrollContentsBy(self, dx, dy):
+        self.interact()
+        QtGui.QGraphicsView.scrollContentsBy(self, dx, dy)
+
+    ZOOM_INCREMENT = 1.0 + 1.0 / 3
 
     def wheelEvent(self, event):
+        self.interact()
         if event.delta() > 0:
-            self.zoom_image(1.0 + 1.0 / 3)
+            self.zoom_image(self.ZOOM_INCREMENT, pos=event.pos())
+        else:
+            self.zoom_image(1.0 / self.ZOOM_INCREMENT, pos=event.pos())
+
+    def mousePressEvent(self, event):
+        self.animation.stop()
+        if event.button() == QtCore.Qt.LeftButton and not self.dragging:
+            self.dragging = True
+            self.begin_draft()
+        self.presstime = time.time()
+        self.presspos = event.pos()
+        QtGui.QGraphicsView.mousePressEvent(self, event)
+
+    def is_click(self, event, click_fuzz=4, click_timeout=1.0):
+        if self.presstime is None:
+            # got a button release without seeing the press?
+            return False
+        delta = self.presspos - event.pos()
+        return (time.time() < self.presstime + click_timeout
+                and math.hypot(delta.x(), delta.y()) < click_fuzz)
+
+    def mouseMoveEvent(self, event):
+        QtGui.QGraphicsView.mouseMoveEvent(self, event)
+        if event.buttons() == QtCore.Qt.NoButton:
+            # coalesce motion into at most one hit-test per frame
+            self.hover_pos = event.pos()
+            if not self.hover_timer.isActive():
+                self.hover_timer.start()
+
+    def mouseReleaseEvent(self, event):
+        QtGui.QGraphicsView.mouseReleaseEvent(self, event)
+        if event.button() == QtCore.Qt.LeftButton and self.dragging:
+            self.dragging = False
+            # hand the drag's draft level over to the idle timer
+            self.interact()
+            self.end_draft()
+        if (event.button() == QtCore.Qt.LeftButton and self.graph
+                and self.is_click(event)):
+            pos = self.mapToScene(event.pos())
+            jump = self.graph.get_jump(pos.x(), pos.y())
+            if jump is not None:
+                self.jump_to(jump)
+
+    def mouseDoubleClickEvent(self, event):
+        if event.button() == QtCore.Qt.LeftButton and self.graph:
+            pos = self.mapToScene(event.pos())
+            for node in self.graph.nodes:
+                if node.is_inside(pos.x(), pos.y()):
+                    self.node_activated.emit(node.id)
+                    return
+        QtGui.QGraphicsView.mouseDoubleClickEvent(self, event)
+
+    def keyPressEvent(self, event):
+        key = event.key()
+        if key == QtCore.Qt.Key_N:
+            self.jump_to_neighbor(1)
+        elif key == QtCore.Qt.Key_P:
+            self.jump_to_neighbor(-1)
+        elif (key in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter)
+                and self.neighbor is not None):
+            # move on to the neighbor we are looking at
+            self.current_node = self.neighbor
+            self.neighbor = None
+            self.neighbor_index = None
+            self.set_highlight(set([self.current_node]))
+        else:
+            QtGui.QGraphicsView.keyPressEvent(self, event)
+
+    def jump_to(self, jump):
+        """Animate to a jump target, and make the node there current."""
+        self.animate_to(jump.x, jump.y)
+        self.current_node = None
+        for item in jump.highlight:
+            if isinstance(item, Node):
+                self.current_node = item
+        self.neighbor = None
+        self.neighbor_index = None
+
+    def find_nodes(self, text):
+        if self.graph is None:
+            return []
+        return self.graph.search_index.search(text)
+
+    def show_node(self, node):
+        """Animate to a node and highlight it."""
+        self.jump_to(Jump(node, node.x, node.y))
+        self.set_highlight(set([node]))
+
+    def jump_to_neighbor(self, step):
+        """Step through the neighbors of the current node."""
+        node = self.current_node
+        if self.graph is None or node is None:
+            return
+        neighbors = self.graph.get_neighbors(node)
+        if not neighbors:
+            return
+        if self.neighbor_index is None:
+            self.neighbor_index = 0 if step > 0 else len(neighbors) - 1
         else:
-            self.zoom_image(3.0 / 4)
+            self.neighbor_index = (self.neighbor_index + step) % len(neighbors)
+        edge, neighbor = neighbors[self.neighbor_index]
+        jump = Jump(edge, neighbor.x, neighbor.y,
+                    highlight=set([node, edge, neighbor]))
+        self.animate_to(jump.x, jump.y)
+        self.set_highlight(jump.highlight)
+        self.neighbor = neighbor
 
 
 class QDotWindow(QtGui.QMainWindow):
+    RELOAD_DELAY = 100  # ms after the last change to the file
+
     def __init__(self, parent=None):
         super(QDotWindow, self).__init__(parent)
 
         self._dotwidget = QDotWidget()
+        self._findResults = []
+        self._findIndex = -1
+        self._dotcode = None
+        self._filename = None
+        # the file name, and which of its graphs is shown if it has several
+        self._document = None
+        self._focus = None
+        self._hops = 1
+        self._folded = set()
+        self._fold_all = False
+        self._digest = None
+        # the graphs of a file that holds several
+        self._graphs = []
+        self._graphIndex = 0
+
+        self._watcher = QtCore.QFileSystemWatcher(self)
+        self._watcher.fileChanged.connect(self._onFileChanged)
+        self._watcher.directoryChanged.connect(self._onDirectoryChanged)
+        self._reloadTimer = QtCore.QTimer(self)
+        self._reloadTimer.setSingleShot(True)
+        self._reloadTimer.setInterval(self.RELOAD_DELAY)
+        self._reloadTimer.timeout.connect(self._reload_file)
+
+        self._server = None
+        self._streamName = None
+        self._streams = {}
+        self._pending = None
+        self._busy = False
+        self._quiet = False
+        self._stdinNotifier = None
+        self._streamTimer = QtCore.QTimer(self)
+        self._streamTimer.setSingleShot(True)
+        self._streamTimer.timeout.connect(self._onStreamTimeout)
 
         self._menubar = QtGui.QMenuBar()
         self.setMenuBar(self._menubar)
@@ -1223,6 +3354,21 @@ class QDotWindow(QtGui.QMainWindow):
         self._zoom100Act = QtGui.QAction(
             QtGui.QIcon.fromTheme('zoom-original'), 'Zoom 100%', self)
 
+        self._findAct = QtGui.QAction(
+            QtGui.QIcon.fromTheme('edit-find'), 'Find', self,
+            shortcut=QtGui.QKeySequence.Find)
+
+        self._focusAct = QtGui.QAction('Neighborhood...', self)
+        self._wholeGraphAct = QtGui.QAction('Whole Graph', self)
+        self._foldAllAct = QtGui.QAction('Fold All Clusters', self)
+        self._unfoldAllAct = QtGui.QAction('Unfold All Clusters', self)
+
+        self._reloadAct = QtGui.QAction(
+            QtGui.QIcon.fromTheme('view-refresh'), 'Reload', self,
+            shortcut=QtGui.QKeySequence.Refresh)
+        self._warmStartAct = QtGui.QAction(
+            'Keep Positions on Reload', self, checkable=True)
+
         self._openFileAct = QtGui.QAction(
             QtGui.QIcon.fromTheme('document-open'), 'Open', self )
         self._ExitAct = QtGui.QAction(
@@ -1235,7 +3381,16 @@ class QDotWindow(QtGui.QMainWindow):
     def _create_menus(self):
         file_menu = self._menubar.addMenu('File')
         file_menu.addAction(self._openFileAct)
+        file_menu.addAction(self._reloadAct)
         file_menu.addAction(self._ExitAct)
+        view_menu = self._menubar.addMenu('View')
+        view_menu.addAction(self._focusAct)
+        view_menu.addAction(self._wholeGraphAct)
+        view_menu.addSeparator()
+        view_menu.addAction(self._foldAllAct)
+        view_menu.addAction(self._unfoldAllAct)
+        view_menu.addSeparator()
+        view_menu.addAction(self._warmStartAct)
 
     def _create_tool_bars(self):
         proj_toolbar = self.addToolBar('Project')
@@ -1244,6 +3399,19 @@ class QDotWindow(QtGui.QMainWindow):
         proj_toolbar.addAction(self._zoom100Act)
         proj_toolbar.addAction(self._zoomFitAct)
 
+        find_toolbar = self.addToolBar('Find')
+        find_toolbar.addAction(self._findAct)
+        self._findEdit = QtGui.QLineEdit()
+        self._findEdit.setPlaceholderText('Find node')
+        find_toolbar.addWidget(self._findEdit)
+        self._findLabel = QtGui.QLabel()
+        find_toolbar.addWidget(self._findLabel)
+
+        graph_toolbar = self.addToolBar('Graphs')
+        self._graphCombo = QtGui.QComboBox()
+        self._graphComboAct = graph_toolbar.addWidget(self._graphCombo)
+        self._graphComboAct.setVisible(False)
+
     def _create_connections(self):
         self._zoomInAct.triggered.connect(self._onZoomIn)
         self._zoomOutAct.triggered.connect(self._onZoomOut)
@@ -1251,6 +3419,20 @@ class QDotWindow(QtGui.QMainWindow):
         self._zoom100Act.triggered.connect(self._onZoom100)
 
         self._openFileAct.triggered.connect(self._open_dot_file)
+        self._reloadAct.triggered.connect(self.reload)
+        self._warmStartAct.toggled.connect(self._dotwidget.set_warm_start)
+
+        self._focusAct.triggered.connect(self._onFocus)
+        self._wholeGraphAct.triggered.connect(self._onWholeGraph)
+        self._foldAllAct.triggered.connect(self._onFoldAll)
+        self._unfoldAllAct.triggered.connect(self._onUnfoldAll)
+        self._dotwidget.node_activated.connect(self._onNodeActivated)
+        self._dotwidget.layout_message.connect(self.statusBar().showMessage)
+        self._findAct.triggered.connect(self._onFind)
+        self._findEdit.textChanged.connect(self._onFindChanged)
+        self._findEdit.returnPressed.connect(self._onFindNext)
+        self._graphCombo.currentIndexChanged[int].connect(
+            self._onGraphSelected)
 
     def _open_dot_file(self):
         dot_file = QtGui.QFileDialog.getOpenFileName(
@@ -1275,21 +3457,313 @@ class QDotWindow(QtGui.QMainWindow):
     def _onZoom100(self):
         self._dotwidget.zoom_cancel()
 
-    def set_dotcode(self, dotcode, filename='<stdin>'):
-        if self._dotwidget.set_dotcode(dotcode, filename):
+    def _onFocus(self):
+        node = self._dotwidget.current_node
+        id, ok = QtGui.QInputDialog.getText(
+            self, 'Neighborhood', 'Node id:',
+            text=node.id if node is not None else '')
+        if not ok or not id:
+            return
+        hops, ok = QtGui.QInputDialog.getInt(
+            self, 'Neighborhood', 'Hops:', self._hops, 1)
+        if ok:
+            self.set_focus(unicode(id).encode('utf8'), hops)
+
+    def _onWholeGraph(self):
+        self.set_focus(None)
+
+    def _onFoldAll(self):
+        graph = self._parse_dotcode()
+        if graph is not None:
+            self.set_folded(graph.get_cluster_ids())
+
+    def _onUnfoldAll(self):
+        self.set_folded(())
+
+    def _onNodeActivated(self, id):
+        # double clicking a folded cluster unfolds it, double clicking a
+        # node in a cluster folds that cluster
+        graph = self._parse_dotcode()
+        if graph is not None:
+            placeholder_ids = graph.get_placeholder_ids(self._folded)
+            for cluster_id, placeholder_id in placeholder_ids.items():
+                if placeholder_id == id:
+                    self.set_folded(self._folded - set([cluster_id]))
+                    return
+            cluster_id = graph.get_cluster_of(id)
+            if cluster_id is not None:
+                self.set_folded(self._folded | set([cluster_id]))
+
+    def _onGraphSelected(self, index):
+        if 0 <= index < len(self._graphs) and index != self._graphIndex:
+            self._graphIndex = index
+            self.set_dotcode(self._graphs[index][1], self._filename)
+
+    def _onFind(self):
+        self._findEdit.setFocus()
+        self._findEdit.selectAll()
+
+    def _onFindChanged(self, text):
+        text = unicode(text).encode('utf8')
+        self._findResults = self._dotwidget.find_nodes(text)
+        self._findIndex = -1
+        if text and not self._findResults:
+            self._findLabel.setText('Not found')
+        else:
+            self._findLabel.setText('')
+        self._onFindNext()
+
+    def _onFindNext(self):
+        if not self._findResults:
+            return
+        self._findIndex = (self._findIndex + 1) % len(self._findResults)
+        self._findLabel.setText(
+            '%d of %d' % (self._findIndex + 1, len(self._findResults)))
+        self._dotwidget.show_node(self._findResults[self._findIndex])
+
+    def set_dotcode(self, dotcode, filename='<stdin>', keep_view=False):
+        if self._busy:
+            # an error dialog runs its own event loop; show the newest
+            # graph once the one being laid out is done
+            self._pending = (dotcode, filename)
+            return
+        self._busy = True
+        try:
+            self._set_dotcode(dotcode, filename, keep_view)
+        finally:
+            self._busy = False
+            if self._pending is not None:
+                self._streamTimer.start(0)
+
+    def _set_dotcode(self, dotcode, filename, keep_view):
+        document = filename
+        if self._graphs:
+            # another graph of the same file is another document, for
+            # folding, restyling and warm start alike
+            document = '%s#%d' % (filename, self._graphIndex)
+        opened = document != self._document
+        self._dotcode = dotcode
+        self._filename = filename
+        self._document = document
+        if opened:
+            self._folded = set()
+            if self._fold_all:
+                graph = self._parse_dotcode()
+                if graph is None:
+                    return
+                self._folded = set(graph.get_cluster_ids())
+        if self._focus is not None or self._folded:
+            graph = self._parse_dotcode()
+            if graph is None:
+                return
+            if self._focus is not None:
+                try:
+                    node_ids = graph.get_neighborhood(self._focus, self._hops)
+                except KeyError:
+                    self._show_error('No node named ' + self._focus)
+                    return
+                graph = graph.subgraph(node_ids)
+            if self._folded:
+                graph = graph.fold(self._folded)
+            dotcode = graph.to_dotcode()
+        if self._dotwidget.set_dotcode(dotcode, document, self._quiet):
             self.setWindowTitle(os.path.basename(filename) + ' - Dot Viewer')
-            self._dotwidget.zoom_to_fit()
+            if self._dotwidget.layout_changed and not keep_view:
+                self._dotwidget.zoom_to_fit()
+
+    def set_document(self, text, filename='<stdin>', keep_view=False):
+        """Show the graph in text or, if there are several, the one selected
+        in the Graphs toolbar; the others are not parsed until selected."""
+        graphs = split_graphs(text)
+        if len(graphs) <= 1:
+            self._graphs = []
+            self._graphComboAct.setVisible(False)
+            self.set_dotcode(text, filename, keep_view)
+            return
+        if filename != self._filename or self._graphIndex >= len(graphs):
+            self._graphIndex = 0
+        self._graphs = graphs
+        self._graphCombo.blockSignals(True)
+        self._graphCombo.clear()
+        self._graphCombo.addItems([name for name, dotcode in graphs])
+        self._graphCombo.setCurrentIndex(self._graphIndex)
+        self._graphCombo.blockSignals(False)
+        self._graphComboAct.setVisible(True)
+        self.set_dotcode(graphs[self._graphIndex][1], filename, keep_view)
+
+    def _parse_dotcode(self):
+        """Return the current source as a DotGraph, or None on errors."""
+        if self._dotcode is None:
+            return None
+        try:
+            return DotGraphParser(self._dotcode).parse()
+        except ParseError, ex:
+            self._show_error(str(ex))
+            return None
+
+    def set_folded(self, cluster_ids):
+        """Lay out the graph with the given clusters folded into one node
+        each."""
+        self._folded = set(cluster_ids)
+        if self._dotcode is not None:
+            self.set_dotcode(self._dotcode, self._filename)
+
+    def set_fold_all(self, fold_all):
+        """Fold every cluster of the graphs opened from now on."""
+        self._fold_all = fold_all
+
+    def set_focus(self, id, hops=1):
+        """Show only the nodes within hops edges of node id, or the whole
+        graph if id is None."""
+        self._focus = id
+        self._hops = hops
+        if self._dotcode is not None:
+            self.set_dotcode(self._dotcode, self._filename)
+
+    def _show_error(self, message):
+        if self._quiet:
+            self.statusBar().showMessage('Error: ' + message)
+            return
+        mbox = QtGui.QMessageBox(self)
+        mbox.setWindowTitle('QDot Viewer')
+        mbox.setText('Error: ' + message)
+        mbox.exec_()
 
     def set_xdotcode(self, xdotcode, filename='<stdin>'):
         if self._dotwidget.set_xdotcode(xdotcode):
             self.setWindowTitle(os.path.basename(filename) + ' - Dot Viewer')
             self._dotwidget.zoom_to_fit()
 
+    def reload(self):
+        if self._dotcode is None:
+            return
+        # an explicit reload always takes a new layout
+        self._dotwidget.invalidate()
+        if self._filename == '<stdin>':
+            self.set_dotcode(self._dotcode, self._filename, keep_view=True)
+        else:
+            self._reload_file(force=True)
+
+    def _onFileChanged(self, path):
+        # editors write in bursts, wait for them to finish
+        self._reloadTimer.start()
+
+    def _onDirectoryChanged(self, path):
+        # a file replaced by rename may have been missing when it was last
+        # read, and is only seen again here
+        filename = self._filename
+        if (filename not in self._watcher.files() and
+                os.path.exists(filename)):
+            self._reloadTimer.start()
+
+    def _reload_file(self, force=False):
+        filename = self._filename
+        try:
+            fp = file(filename, 'rt')
+            dotcode = fp.read()
+            fp.close()
+        except IOError:
+            # being replaced, its directory tells when it is back
+            dotcode = None
+        # files replaced on save are no longer watched
+        if filename not in self._watcher.files() and os.path.exists(filename):
+            self._watcher.addPath(filename)
+        if dotcode is None:
+            return
+        digest = get_digest(dotcode)
+        if digest == self._digest and not force:
+            return
+        self._digest = digest
+        self.set_document(dotcode, filename, keep_view=True)
+
+    def watch_file(self, filename):
+        """Reload filename whenever it changes."""
+        paths = self._watcher.files() + self._watcher.directories()
+        if paths:
+            self._watcher.removePaths(paths)
+        self._watcher.addPath(filename)
+        # editors that save by renaming over the file leave it missing for
+        # a moment
+        self._watcher.addPath(os.path.dirname(os.path.abspath(filename)))
+
+    def listen(self, name):
+        """Show the graphs written to the local socket name as they come.
+
+        When graphs arrive faster than they are laid out, the ones in
+        between are skipped.
+        """
+        from PyQt4 import QtNetwork
+        self._server = QtNetwork.QLocalServer(self)
+        if not listen_local(self._server, name):
+            self._show_error('Can not listen on %s: %s' % (
+                name, self._server.errorString()))
+            return False
+        self._streamName = name
+        self._server.newConnection.connect(self._onNewConnection)
+        return True
+
+    def _onNewConnection(self):
+        while self._server.hasPendingConnections():
+            socket = self._server.nextPendingConnection()
+            self._streams[socket] = DotSplitter()
+            socket.readyRead.connect(lambda socket=socket:
+                                     self._onStreamData(socket))
+            socket.disconnected.connect(lambda socket=socket:
+                                        self._onStreamClosed(socket))
+
+    def _onStreamData(self, socket):
+        graphs = self._streams[socket].feed(str(socket.readAll()))
+        if graphs:
+            self._queue_graph(graphs[-1], self._streamName)
+
+    def _queue_graph(self, dotcode, name):
+        self._pending = (dotcode, name)
+        # lay out once the data that is already waiting is read
+        self._streamTimer.start(0)
+
+    def follow(self, fd, name='<stdin>'):
+        """Show the graphs read from file descriptor fd as they come, like
+        those written to the socket of listen()."""
+        splitter = DotSplitter()
+
+        def on_read():
+            data = os.read(fd, 65536)
+            if not data:
+                self._stdinNotifier.setEnabled(False)
+                return
+            graphs = splitter.feed(data)
+            if graphs:
+                self._queue_graph(graphs[-1], name)
+
+        self._stdinNotifier = QtCore.QSocketNotifier(
+            fd, QtCore.QSocketNotifier.Read, self)
+        self._stdinNotifier.activated.connect(on_read)
+
+    def _onStreamClosed(self, socket):
+        del self._streams[socket]
+        socket.deleteLater()
+
+    def _onStreamTimeout(self):
+        if self._pending is not None and not self._busy:
+            dotcode, name = self._pending
+            self._pending = None
+            # a bad graph in a stream is soon followed by a good one, so
+            # do not stop for it
+            self._quiet = True
+            try:
+                self.set_dotcode(dotcode, name,
+                                 keep_view=(self._filename == name))
+            finally:
+                self._quiet = False
+
     def open_file(self, filename):
         try:
             fp = file(filename, 'rt')
-            self.set_dotcode(fp.read(), filename)
+            dotcode = fp.read()
             fp.close()
+            self._digest = get_digest(dotcode)
+            self.watch_file(filename)
+            self.set_document(dotcode, filename)
         except IOError, ex:
             mbox = QtGui.QMessageBox(self)
             mbox.setText('File not found or can not open: ' + filename)
@@ -1299,6 +3773,21 @@ class QDotWindow(QtGui.QMainWindow):
     def set_filter(self, filter):
         self._dotwidget.set_filter(filter)
 
+    def set_size_limits(self, nodes, edges):
+        self._dotwidget.set_size_limits(nodes, edges)
+
+    def set_layout_budget(self, budget):
+        self._dotwidget.set_layout_budget(budget)
+
+    def set_components(self, components):
+        self._dotwidget.set_components(components)
+
+    def set_library(self, library):
+        self._dotwidget.set_library(library)
+
+    def set_warm_start(self, warm_start):
+        self._warmStartAct.setChecked(warm_start)
+
 
 def debug_trace():
     '''Set a tracepoint in the Python debugger that works with Qt'''
@@ -1308,46 +3797,460 @@ def debug_trace():
     set_trace()
 
 
-def has_graphviz():
+def render_image(graph, zoom=1.0, margin=8):
+    """Paint graph on a white QImage."""
+    x, y, w, h = graph.get_rect()
+    width = int(math.ceil(w * zoom)) + 2 * margin
+    height = int(math.ceil(h * zoom)) + 2 * margin
+    image = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32)
+    image.fill(QtGui.QColor(255, 255, 255).rgba())
+    painter = QtGui.QPainter(image)
+    painter.setRenderHints(QDotWidget.QUALITY_HINTS)
+    painter.translate(margin, margin)
+    painter.scale(zoom, zoom)
+    painter.translate(-x, -y)
+    graph.draw(None, painter, QtCore.QRectF(x, y, w, h))
+    painter.end()
+    return image
+
+
+def cached_layout(filter, dotcode, cache_dir=None, timeout=None):
+    """Lay out dotcode, reusing the xdot code of the same layout if it was
+    saved in cache_dir before."""
+    if cache_dir is None:
+        return XDotParser(filter_pool.run(filter, dotcode, timeout)).parse()
+    key = get_digest(filter + '\0' + dotcode).encode('hex')
+    path = os.path.join(cache_dir, key + '.xdot')
+    try:
+        fp = open(path, 'rt')
+        xdotcode = fp.read()
+        fp.close()
+    except IOError:
+        xdotcode = filter_pool.run(filter, dotcode, timeout)
+        # other workers may be writing the same layout
+        temp_path = '%s.%d' % (path, os.getpid())
+        fp = open(temp_path, 'wt')
+        fp.write(xdotcode)
+        fp.close()
+        os.rename(temp_path, path)
+    return XDotParser(xdotcode).parse()
+
+
+# the QApplication of a batch rendering process
+_renderer_app = None
+
+
+def init_renderer():
+    """Set up the current process to render without a display."""
+    global _renderer_app
+    if _renderer_app is None:
+        _renderer_app = QtGui.QApplication(['qdot'], False)
+
+
+def render_file(job):
+    """Lay out and render one DOT file to PNG, in a batch worker.
+
+    Returns the file names and an error message, or None.
+    """
+    filename, output, filter, zoom, cache_dir, limits, budget = job
+    try:
+        fp = open(filename, 'rt')
+        dotcode = fp.read()
+        fp.close()
+        filter, message = choose_filter(filter, dotcode, limits)
+        if message is not None:
+            sys.stderr.write('%s: %s\n' % (filename, message))
+        graph, message = degrade_layout(
+            lambda filter, dotcode, timeout:
+                cached_layout(filter, dotcode, cache_dir, timeout),
+            filter, dotcode, budget)
+        if message is not None:
+            sys.stderr.write('%s: %s\n' % (filename, message))
+        if not render_image(graph, zoom).save(output, 'PNG'):
+            return filename, output, 'can not write ' + output
+    except (IOError, OSError, ParseError, LayoutError), ex:
+        return filename, output, str(ex).strip()
+    except Exception, ex:
+        # a malformed file must not stop the rest of the batch
+        return filename, output, '%s: %s' % (type(ex).__name__, ex)
+    return filename, output, None
+
+
+def render_batch(paths, output_dir, filter='dot', processes=None, zoom=1.0,
+                 cache_dir=None, limits=None, budget=None):
+    """Render DOT files, and the .dot and .gv files in directories, to PNG
+    images in output_dir, one file per worker process at a time.
+
+    Returns the number of files that failed.
+    """
+    import multiprocessing
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted([
+                os.path.join(path, name) for name in os.listdir(path)
+                if os.path.splitext(name)[1] in ('.dot', '.gv')]))
+        else:
+            filenames.append(path)
+    for directory in (output_dir, cache_dir):
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+    jobs = []
+    outputs = {}
+    failures = 0
+    for filename in filenames:
+        name = os.path.splitext(os.path.basename(filename))[0] + '.png'
+        output = os.path.join(output_dir, name)
+        if output in outputs:
+            failures += 1
+            sys.stderr.write('%s: skipped, %s is rendered from %s\n' % (
+                filename, output, outputs[output]))
+            continue
+        outputs[output] = filename
+        jobs.append((filename, output, filter, zoom, cache_dir, limits,
+                     budget))
+    if not jobs:
+        return failures
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(min(processes, len(jobs)), init_renderer)
+    try:
+        for filename, output, error in pool.imap_unordered(render_file, jobs):
+            if error is None:
+                sys.stdout.write('%s -> %s\n' % (filename, output))
+            else:
+                failures += 1
+                sys.stderr.write('%s: %s\n' % (filename, error))
+    finally:
+        pool.close()
+        pool.join()
+    return failures
+
+
+def iter_graphs(fp):
+    """Yield the DOT graphs read from fp, each as soon as it is complete."""
+    splitter = DotSplitter()
+    fd = fp.fileno()
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        for dotcode in splitter.feed(data):
+            yield dotcode
+
+
+def render_frames(fp, output_dir, filter='dot', processes=None, zoom=1.0,
+                  limits=None, budget=None):
+    """Render each graph read from fp to a numbered PNG frame in output_dir.
+
+    The next graphs are laid out while a frame is painted and saved, at
+    most two per process ahead. Returns the number of graphs that failed.
+    """
+    import multiprocessing
+    import multiprocessing.pool
+    init_renderer()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    slots = threading.Semaphore(2 * processes)
+    aborted = threading.Event()
+
+    def graphs():
+        for dotcode in iter_graphs(fp):
+            slots.acquire()
+            if aborted.is_set():
+                return
+            yield dotcode
+
+    def layout(dotcode):
+        try:
+            # the warning would repeat for every frame
+            chosen, message = choose_filter(filter, dotcode, limits)
+            graph, message = degrade_layout(layout_graph, chosen, dotcode,
+                                            budget)
+            return graph, None, message
+        except (ParseError, LayoutError), ex:
+            return None, str(ex).strip(), None
+        except Exception, ex:
+            # a graph that breaks the parser must not stop the animation
+            return None, '%s: %s' % (type(ex).__name__, ex), None
+
+    pool = multiprocessing.pool.ThreadPool(processes)
+    failures = 0
     try:
-        fnull = open(os.devnull, 'w')
-        subprocess.check_call(["which", "dot"], stdout=fnull, stderr=fnull)
-        fnull.close()
+        frames = pool.imap(layout, graphs())
+        for number, (graph, error, message) in enumerate(frames, 1):
+            slots.release()
+            if message is not None:
+                sys.stderr.write('frame %d: %s\n' % (number, message))
+            output = os.path.join(output_dir, 'frame-%05d.png' % number)
+            if error is None and not render_image(graph, zoom).save(output,
+                                                                    'PNG'):
+                error = 'can not write ' + output
+            if error is None:
+                sys.stdout.write(output + '\n')
+            else:
+                failures += 1
+                sys.stderr.write('frame %d: %s\n' % (number, error))
+    except:
+        # the pool can not be joined while graphs() waits for a slot
+        aborted.set()
+        slots.release()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    return failures
+
+
+def get_digest(text):
+    return hashlib.md5(text).digest()
+
+
+class InstanceServer(QtCore.QObject):
+    """Opens the files handed over by other qdot invocations, each in a new
+    window."""
+
+    def __init__(self, create_window, parent=None):
+        from PyQt4 import QtNetwork
+        QtCore.QObject.__init__(self, parent)
+        self.create_window = create_window
+        self.windows = []
+        self.buffers = {}
+        self.server = QtNetwork.QLocalServer(self)
+        self.server.newConnection.connect(self.on_new_connection)
+
+    def listen(self, name=None):
+        if name is None:
+            name = get_instance_name()
+        return listen_local(self.server, name)
+
+    def on_new_connection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.buffers[socket] = ''
+            socket.readyRead.connect(lambda socket=socket:
+                                     self.on_ready_read(socket))
+            socket.disconnected.connect(lambda socket=socket:
+                                        self.on_disconnected(socket))
+
+    def on_ready_read(self, socket):
+        lines = (self.buffers[socket] + str(socket.readAll())).split('\n')
+        self.buffers[socket] = lines.pop()
+        for filename in lines:
+            if filename:
+                self.open_file(filename)
+
+    def on_disconnected(self, socket):
+        del self.buffers[socket]
+        socket.deleteLater()
+
+    def open_file(self, filename):
+        # QDotWindow.open_file exits on files it can not read
+        if not os.path.isfile(filename):
+            return
+        win = self.create_window()
+        self.windows.append(win)
+        win.show()
+        win.raise_()
+        win.activateWindow()
+        win.open_file(filename)
+
+
+def listen_local(server, name, timeout=1000):
+    """Make server listen on the local socket name, taking the socket over
+    only when whoever created it no longer answers."""
+    from PyQt4 import QtNetwork
+    if server.listen(name):
         return True
-    except subprocess.CalledProcessError:
+    socket = QtNetwork.QLocalSocket()
+    socket.connectToServer(name)
+    if socket.waitForConnected(timeout):
+        # a running viewer owns it
+        socket.disconnectFromServer()
         return False
+    # left behind by a viewer that crashed
+    QtNetwork.QLocalServer.removeServer(name)
+    return server.listen(name)
+
+
+def find_program(name):
+    """Return the path of program name on the PATH, or None."""
+    extensions = ['']
+    if os.name == 'nt':
+        extensions += os.environ.get('PATHEXT', '.EXE').split(os.pathsep)
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        for extension in extensions:
+            path = os.path.join(directory, name + extension)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
 
 
 def main():
     import optparse
 
-    if not has_graphviz():
-        print 'qdot.py depends on Graphviz. Please install it on your system. More information on Graphviz (http://www.graphviz.org/)'
-        sys.exit(-1)
-
     parser = optparse.OptionParser(
-        usage='\n\t%prog [file]',
+        usage='\n\t%prog [file]\n\t%prog --batch DIR file|dir...',
         version='%%prog %s' % __version__)
     parser.add_option(
         '-f', '--filter',
-        type='choice', choices=('dot', 'neato', 'twopi', 'circo', 'fdp'),
+        type='choice',
+        choices=('dot', 'neato', 'twopi', 'circo', 'fdp', 'sfdp', 'auto'),
         dest='filter', default='dot',
-        help='graphviz filter: dot, neato, twopi, circo, or fdp [default: %default]')
+        help='graphviz filter: dot, neato, twopi, circo, fdp, sfdp, or auto '
+             'for dot or, on large graphs, sfdp [default: %default]')
+    parser.add_option(
+        '--large-nodes', metavar='N',
+        type='int', dest='large_nodes', default=LARGE_NODES,
+        help='graphs with more nodes are large, and laid out with sfdp by '
+             '--filter auto [default: %default]')
+    parser.add_option(
+        '--large-edges', metavar='N',
+        type='int', dest='large_edges', default=LARGE_EDGES,
+        help='graphs with more edges are large [default: %default]')
+    parser.add_option(
+        '--layout-budget', metavar='SECONDS',
+        type='float', dest='layout_budget', default=None,
+        help='retry layouts that take longer with fewer iterations, then '
+             'straight edges, then sfdp')
+    parser.add_option(
+        '--focus', metavar='NODE',
+        dest='focus', default=None,
+        help='only lay out and show the neighborhood of NODE')
+    parser.add_option(
+        '--hops',
+        type='int', dest='hops', default=1,
+        help='size of the --focus neighborhood in edges [default: %default]')
+    parser.add_option(
+        '--fold',
+        action='store_true', dest='fold', default=False,
+        help='start with every cluster folded into a single node')
+    parser.add_option(
+        '--components',
+        action='store_true', dest='components', default=False,
+        help='lay out connected components in parallel and pack them')
+    parser.add_option(
+        '--libgvc',
+        action='store_true', dest='library', default=False,
+        help='lay out in process with the graphviz library if available')
+    parser.add_option(
+        '--warm-start',
+        action='store_true', dest='warm_start', default=False,
+        help='relayout reloaded graphs from the previous node positions '
+             '(neato, fdp)')
+    parser.add_option(
+        '--listen', metavar='NAME',
+        dest='listen', default=None,
+        help='show the graphs written to local socket NAME as they arrive')
+    parser.add_option(
+        '-1', '--single-instance',
+        action='store_true', dest='single_instance', default=False,
+        help='open the file in a viewer that is already running, if any')
+    parser.add_option(
+        '--startup-timing',
+        action='store_true', dest='startup_timing', default=False,
+        help='report the time to the first paint of the window and graph')
+    parser.add_option(
+        '--batch', metavar='DIR',
+        dest='batch', default=None,
+        help='render the given files, and the DOT files in the given '
+             'directories, to PNG images in DIR without opening a window')
+    parser.add_option(
+        '-j', '--jobs',
+        type='int', dest='jobs', default=None,
+        help='number of --batch worker processes, or of --frames layouts '
+             'run ahead [default: one per CPU]')
+    parser.add_option(
+        '--zoom',
+        type='float', dest='zoom', default=1.0,
+        help='zoom ratio of --batch and --frames images [default: %default]')
+    parser.add_option(
+        '--layout-cache', metavar='DIR',
+        dest='layout_cache', default=None,
+        help='keep --batch layouts in DIR and reuse them for unchanged files')
+    parser.add_option(
+        '--stream',
+        action='store_true', dest='stream', default=False,
+        help='read one graph after another from stdin and show each as it '
+             'arrives')
+    parser.add_option(
+        '--frames', metavar='DIR',
+        dest='frames', default=None,
+        help='with --stream, write the graphs to numbered PNG images in DIR '
+             'instead of showing them')
 
     (options, args) = parser.parse_args(sys.argv[1:])
+    limits = (options.large_nodes, options.large_edges)
+    if options.batch is not None:
+        failures = render_batch(args, options.batch, options.filter,
+                                options.jobs, options.zoom,
+                                options.layout_cache, limits,
+                                options.layout_budget)
+        sys.exit(failures and 1 or 0)
+    if options.stream and options.frames is not None:
+        failures = render_frames(sys.stdin, options.frames, options.filter,
+                                 options.jobs, options.zoom, limits,
+                                 options.layout_budget)
+        sys.exit(failures and 1 or 0)
     if len(args) > 1:
         parser.error('incorrect number of arguments')
 
+    if (options.single_instance and args and os.path.isfile(args[0]) and
+            forward_to_instance(args[0])):
+        sys.exit(0)
+
+    def create_window():
+        win = QDotWindow()
+        win.set_filter(options.filter)
+        win.set_size_limits(*limits)
+        win.set_layout_budget(options.layout_budget)
+        win.set_components(options.components)
+        win.set_library(options.library)
+        win.set_warm_start(options.warm_start)
+        win.set_focus(options.focus, options.hops)
+        win.set_fold_all(options.fold)
+        return win
+
     app = QtGui.QApplication(sys.argv)
-    win = QDotWindow()
+    win = create_window()
     win.show()
 
-    win.set_filter(options.filter)
-    if len(args) >= 1:
-        if args[0] == '-':
-            win.set_dotcode(sys.stdin.read())
-        else:
-            win.open_file(args[0])
+    if options.single_instance:
+        server = InstanceServer(create_window, app)
+        server.listen()
+    if options.listen is not None:
+        win.listen(options.listen)
+
+    def report(what):
+        if options.startup_timing:
+            sys.stderr.write('%s: %.3fs\n' % (what, time.time() - START_TIME))
+    report('window created')
+
+    def load():
+        if options.stream:
+            win.follow(sys.stdin.fileno())
+        elif len(args) >= 1:
+            if args[0] == '-':
+                win.set_document(sys.stdin.read())
+            else:
+                win.open_file(args[0])
+
+    painted = []
+
+    def on_paint(has_graph):
+        if not painted:
+            painted.append(True)
+            report('first paint')
+            # lay out once the empty window is on screen
+            QtCore.QTimer.singleShot(0, load)
+        elif has_graph:
+            report('first graph paint')
+        if has_graph or not options.startup_timing:
+            win._dotwidget.paint_hook = None
+    win._dotwidget.paint_hook = on_paint
 
     sys.exit(app.exec_())
 
@@ -377,6 +377,39 @@ def square_distance(x1, y1, x2, y2):
     return deltax*deltax + deltay*deltay
 
 
+def flatten_bezier(points, steps=8):
+    """Approximate a piecewise cubic bezier with a polyline."""
+    if len(points) < 4 or (len(points) - 1) % 3:
+        return list(points)
+    polyline = [points[0]]
+    for i in xrange(1, len(points), 3):
+        x0, y0 = points[i - 1]
+        x1, y1 = points[i]
+        x2, y2 = points[i + 1]
+        x3, y3 = points[i + 2]
+        for j in xrange(1, steps + 1):
+            t = float(j)/steps
+            s = 1.0 - t
+            a, b, c, d = s*s*s, 3*s*s*t, 3*s*t*t, t*t*t
+            polyline.append((a*x0 + b*x1 + c*x2 + d*x3,
+                             a*y0 + b*y1 + c*y2 + d*y3))
+    return polyline
+
+
+def segment_square_distance(x, y, x1, y1, x2, y2):
+    """Return the square distance from a point to a segment, and where along
+    the segment (0 to 1) the closest point is."""
+    deltax = x2 - x1
+    deltay = y2 - y1
+    length = deltax*deltax + deltay*deltay
+    if length:
+        t = ((x - x1)*deltax + (y - y1)*deltay)/length
+        t = max(0.0, min(t, 1.0))
+    else:
+        t = 0.0
+    return square_distance(x, y, x1 + t*deltax, y1 + t*deltay), t
+
+
 class Edge(Element):
 
     def __init__(self, src, dst, points, shapes):
@@ -384,15 +417,83 @@ class Edge(Element):
         self.src = src
         self.dst = dst
         self.points = points
+        self.segments = None
 
     RADIUS = 10
 
+    def get_segments(self):
+        """Return the flattened edge as (x1, y1, x2, y2, p1, p2) segments,
+        where p1 and p2 say how far along the edge (0 to 1) they are."""
+        if self.segments is None:
+            polyline = flatten_bezier(self.points)
+            if len(polyline) == 1:
+                polyline = polyline*2
+            n = float(len(polyline) - 1)
+            self.segments = [
+                polyline[i] + polyline[i + 1] + (i/n, (i + 1)/n)
+                for i in xrange(len(polyline) - 1)
+            ]
+        return self.segments
+
     def get_jump(self, x, y):
-        if square_distance(x, y, *self.points[0]) <= self.RADIUS*self.RADIUS:
+        best_distance = self.RADIUS*self.RADIUS
+        position = None
+        for x1, y1, x2, y2, p1, p2 in self.get_segments():
+            distance, t = segment_square_distance(x, y, x1, y1, x2, y2)
+            if distance <= best_distance:
+                best_distance = distance
+                position = p1 + t*(p2 - p1)
+        if position is None:
+            return None
+        return self.jump_from(position)
+
+    def jump_from(self, position):
+        """Jump to the far end of the edge, seen from a point that is
+        position (0 to 1) along it."""
+        if position < 0.5:
             return Jump(self, self.dst.x, self.dst.y, highlight=set([self, self.dst]))
-        if square_distance(x, y, *self.points[-1]) <= self.RADIUS*self.RADIUS:
-            return Jump(self, self.src.x, self.src.y, highlight=set([self, self.src]))
-        return None
+        return Jump(self, self.src.x, self.src.y, highlight=set([self, self.src]))
+
+
+class EdgeIndex(object):
+    """Uniform grid over the flattened edge segments, so that the edge
+    nearest to a point is found by looking at a few cells only."""
+
+    CELL = 32.0
+
+    def __init__(self, edges):
+        self.cells = {}
+        for edge in edges:
+            for segment in edge.get_segments():
+                x1, y1, x2, y2 = segment[:4]
+                entry = (edge, segment)
+                for cell in self.get_cells(min(x1, x2), min(y1, y2),
+                                           max(x1, x2), max(y1, y2)):
+                    self.cells.setdefault(cell, []).append(entry)
+
+    def get_cells(self, x1, y1, x2, y2):
+        i1 = int(math.floor(x1/self.CELL))
+        j1 = int(math.floor(y1/self.CELL))
+        i2 = int(math.floor(x2/self.CELL))
+        j2 = int(math.floor(y2/self.CELL))
+        for i in xrange(i1, i2 + 1):
+            for j in xrange(j1, j2 + 1):
+                yield i, j
+
+    def get_jump(self, x, y, radius):
+        best_distance = radius*radius
+        best = None
+        for cell in self.get_cells(x - radius, y - radius, x + radius, y + radius):
+            for edge, segment in self.cells.get(cell, ()):
+                x1, y1, x2, y2, p1, p2 = segment
+                distance, t = segment_square_distance(x, y, x1, y1, x2, y2)
+                if distance <= best_distance:
+                    best_distance = distance
+                    best = edge, p1 + t*(p2 - p1)
+        if best is None:
+            return None
+        edge, position = best
+        return edge.jump_from(position)
 
 
 class Graph(Shape):
@@ -405,22 +506,70 @@ class Graph(Shape):
         self.shapes = shapes
         self.nodes = nodes
         self.edges = edges
+        self.edge_index = None
+        # the unhighlighted background shapes and edges, and nodes
+        self.recordings = None
 
     def get_size(self):
         return self.width, self.height
 
+    def record(self):
+        """Record the unhighlighted graph once, so that drawing it becomes a
+        single replay inside cairo instead of one Python call per path
+        operation.  Needs cairo recording surfaces (pycairo >= 1.11)."""
+        if not hasattr(cairo, 'RecordingSurface'):
+            return
+        recordings = []
+        for draw in (self.draw_edges, self.draw_nodes):
+            recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                                               None)
+            cr = pangocairo.CairoContext(cairo.Context(recording))
+            self.set_defaults(cr)
+            draw(cr, ())
+            recordings.append(recording)
+        self.recordings = recordings
+
     def draw(self, cr, highlight_items=None):
         if highlight_items is None:
             highlight_items = ()
+
+        if self.recordings is None:
+            self.set_defaults(cr)
+            self.draw_edges(cr, highlight_items)
+            self.draw_nodes(cr, highlight_items)
+            return
+
+        # highlighted items go over their recorded unhighlighted selves, in
+        # their layer, so highlighted edges stay below the nodes
+        edges, nodes = self.recordings
+        self.replay(cr, edges)
+        for item in highlight_items:
+            if isinstance(item, Edge):
+                item.draw(cr, highlight=True)
+        self.replay(cr, nodes)
+        for item in highlight_items:
+            if isinstance(item, Node):
+                item.draw(cr, highlight=True)
+
+    def replay(self, cr, recording):
+        cr.save()
+        cr.set_source_surface(recording, 0, 0)
+        cr.paint()
+        cr.restore()
+
+    def set_defaults(self, cr):
         cr.set_source_rgba(0.0, 0.0, 0.0, 1.0)
 
         cr.set_line_cap(cairo.LINE_CAP_BUTT)
         cr.set_line_join(cairo.LINE_JOIN_MITER)
 
+    def draw_edges(self, cr, highlight_items):
         for shape in self.shapes:
             shape.draw(cr)
         for edge in self.edges:
             edge.draw(cr, highlight=(edge in highlight_items))
+
+    def draw_nodes(self, cr, highlight_items):
         for node in self.nodes:
             node.draw(cr, highlight=(node in highlight_items))
 
@@ -432,10 +581,11 @@ class Graph(Shape):
         return None
 
     def get_jump(self, x, y):
-        for edge in self.edges:
-            jump = edge.get_jump(x, y)
-            if jump is not None:
-                return jump
+        if self.edge_index is None:
+            self.edge_index = EdgeIndex(self.edges)
+        jump = self.edge_index.get_jump(x, y, Edge.RADIUS)
+        if jump is not None:
+            return jump
         for node in self.nodes:
             jump = node.get_jump(x, y)
             if jump is not None:
@@ -1278,16 +1428,7 @@ class DragAction(object):
 class NullAction(DragAction):
 
     def on_motion_notify(self, event):
-        dot_widget = self.dot_widget
-        item = dot_widget.get_url(event.x, event.y)
-        if item is None:
-            item = dot_widget.get_jump(event.x, event.y)
-        if item is not None:
-            dot_widget.window.set_cursor(gtk.gdk.Cursor(gtk.gdk.HAND2))
-            dot_widget.set_highlight(item.highlight)
-        else:
-            dot_widget.window.set_cursor(gtk.gdk.Cursor(gtk.gdk.ARROW))
-            dot_widget.set_highlight(None)
+        self.dot_widget.queue_hover(event.x, event.y)
 
 
 class PanAction(DragAction):
@@ -1383,6 +1524,11 @@ class DotWidget(gtk.DrawingArea):
         self.drag_action = NullAction(self)
         self.presstime = None
         self.highlight = None
+        self.backing = None
+        self.backing_key = None
+        self.hover_id = None
+        self.hover_pos = None
+        self.hover_key = None
 
     def set_filter(self, filter):
         self.filter = filter
@@ -1425,6 +1571,7 @@ class DotWidget(gtk.DrawingArea):
         #print xdotcode
         parser = XDotParser(xdotcode)
         self.graph = parser.parse()
+        self.graph.record()
         self.zoom_image(self.zoom_ratio, center=True)
 
     def do_expose_event(self, event):
@@ -1437,21 +1584,70 @@ class DotWidget(gtk.DrawingArea):
         )
         cr.clip()
 
+        cr.set_source_surface(self.get_backing(cr), 0, 0)
+        cr.paint()
+
+        self.drag_action.draw(cr)
+
+        return False
+
+    def get_backing(self, cr):
+        """Return a surface with the graph drawn at the current view.
+
+        Panning scrolls the pixels already there and only draws the strips
+        it uncovers; the surface is redrawn from scratch when the graph, the
+        highlight, the zoom ratio or the widget size change.
+        """
+        rect = self.get_allocation()
+        width, height = rect.width, rect.height
+        key = (self.graph, self.highlight, self.zoom_ratio, width, height)
+
+        backing = self.backing
+        if backing is not None and key == self.backing_key:
+            dx = int(round((self.x - self.backing_x)*self.zoom_ratio))
+            dy = int(round((self.y - self.backing_y)*self.zoom_ratio))
+            if dx == 0 and dy == 0:
+                return backing
+            if abs(dx) < width and abs(dy) < height:
+                surface = backing.create_similar(cairo.CONTENT_COLOR, width, height)
+                bcr = cairo.Context(surface)
+                bcr.set_source_surface(backing, -dx, -dy)
+                bcr.paint()
+                self.backing_x += dx/self.zoom_ratio
+                self.backing_y += dy/self.zoom_ratio
+                if dx > 0:
+                    self.draw_backing(surface, width - dx, 0, dx, height)
+                elif dx < 0:
+                    self.draw_backing(surface, 0, 0, -dx, height)
+                if dy > 0:
+                    self.draw_backing(surface, 0, height - dy, width, dy)
+                elif dy < 0:
+                    self.draw_backing(surface, 0, 0, width, -dy)
+                self.backing = surface
+                return surface
+
+        surface = cr.get_target().create_similar(cairo.CONTENT_COLOR, width, height)
+        self.backing_key = key
+        self.backing_x = self.x
+        self.backing_y = self.y
+        self.draw_backing(surface, 0, 0, width, height)
+        self.backing = surface
+        return surface
+
+    def draw_backing(self, surface, x, y, width, height):
+        cr = pangocairo.CairoContext(cairo.Context(surface))
+        cr.rectangle(x, y, width, height)
+        cr.clip()
+
         cr.set_source_rgba(1.0, 1.0, 1.0, 1.0)
         cr.paint()
 
-        cr.save()
         rect = self.get_allocation()
         cr.translate(0.5*rect.width, 0.5*rect.height)
         cr.scale(self.zoom_ratio, self.zoom_ratio)
-        cr.translate(-self.x, -self.y)
+        cr.translate(-self.backing_x, -self.backing_y)
 
         self.graph.draw(cr, highlight_items=self.highlight)
-        cr.restore()
-
-        self.drag_action.draw(cr)
-
-        return False
 
     def get_current_pos(self):
         return self.x, self.y
@@ -1639,6 +1835,36 @@ class DotWidget(gtk.DrawingArea):
         self.animation = ZoomToAnimation(self, x, y)
         self.animation.start()
 
+    HOVER_INTERVAL = 16 # ms, about one frame
+
+    def queue_hover(self, x, y):
+        """Hit-test the pointer position, at most once per frame."""
+        self.hover_pos = x, y
+        if self.hover_id is None:
+            self.hover_id = gobject.timeout_add(self.HOVER_INTERVAL, self.on_hover)
+
+    def on_hover(self):
+        self.hover_id = None
+        if not isinstance(self.drag_action, NullAction):
+            return False
+        x, y = self.window2graph(*self.hover_pos)
+        if self.hover_key is not None:
+            graph, hx, hy = self.hover_key
+            if graph is self.graph and abs(x - hx) < 1 and abs(y - hy) < 1:
+                return False
+        self.hover_key = self.graph, x, y
+
+        item = self.graph.get_url(x, y)
+        if item is None:
+            item = self.graph.get_jump(x, y)
+        if item is not None:
+            self.window.set_cursor(gtk.gdk.Cursor(gtk.gdk.HAND2))
+            self.set_highlight(item.highlight)
+        else:
+            self.window.set_cursor(gtk.gdk.Cursor(gtk.gdk.ARROW))
+            self.set_highlight(None)
+        return False
+
     def window2graph(self, x, y):
         rect = self.get_allocation()
         x -= 0.5*rect.width